@@ -16,155 +16,567 @@ we read the job params, query all playlist recordings, run the worker's
 AED over them as a single batch (worker_id=0), write detections +
 playlist_aed + feature npy files, then set the terminal job state.
 
-Reuses the upstream worker lib (aed_lib.find_events / compute_features /
-store_roi_images / download_and_get_spec / to_unitcirc) verbatim; only
-the orchestration (no Lambda fan-out / context) is new.
+Sharded mode (scale-out across nodes without Lambda) fits a k8s Indexed
+Job with completions=N plus one follow-up reduce Job:
 
-S3: aed_lib is patched to honor S3_ENDPOINT (-> s3-proxy). DB: db.py
+    python3 aed_run_job.py <job_id> --shard $(JOB_COMPLETION_INDEX)/N
+    python3 aed_run_job.py <job_id> --reduce N
+
+Each shard deterministically picks its part of the playlist (packed to an
+even estimated cost by aed_sched, like the conductor's Lambda chunks),
+writes its detections, and uploads <job>_<i> feature shards plus a
+<job>_<i>_status.json to detection/<job>/shards/. Shards never set the
+terminal job state. The reduce step merges the shards into the usual
+<job>_0 feature files, writes playlist_aed and sets the final state and
+unprocessed-percentage remark; a shard with no status file counts all of
+its recordings as unprocessed.
+
+Reuses the upstream worker lib (aed_lib.find_events / feature_block /
+render_roi_images via aed_lib.analyze_recording, to_unitcirc); only the
+orchestration (no Lambda fan-out / context) is new. AED_PIPELINE=async
+runs the per-recording work as an asyncio staged pipeline (aed_pipeline)
+instead of one serial loop. With AED_CACHE_PREFIX set, per-recording
+results are reused across jobs with the same parameters (aed_cache).
+Per-recording stage timings go to <job>_<i>_metrics.jsonl next to the
+feature files (aed_metrics); AED_PROM_TEXTFILE adds live counters.
+AED_PROFILE_* sample recordings for cProfile/tracemalloc (aed_profile).
+The "Max Events" / "Event Rank" job parameters cap each recording's
+events to the top K by energy, area or peak (aed_lib.rank_events); the
+number dropped goes into the job remark.
+"Feature Dtype" / "Feature Reduction" / "Feature Dims" add compact
+<job>_0_meta / _hog / _features_reduced files next to the full feature
+file (aed_compact). "Build Index" adds an IVF nearest-neighbour index
+over the final features, <job>_0_index.npz (aed_index). "Clusters" (k)
+fits a streaming mini-batch k-means while the features are written and
+uploads <job>_0_clusters.npy / _centroids.npy (aed_cluster).
+"Min Frequency" / "Max Frequency" (kHz) restrict detection to a band:
+recordings are decimated and only the band's STFT bins computed, with
+detections still in absolute Hz (aed_lib.get_spec). "Detection Mode":
+coarse filters at full resolution only around candidates found on a
+pooled spectrogram (aed_lib.coarse_mask; recall measured by the bench).
+AED_REC_TIMEOUT / AED_REC_MAXMEM run each recording's DSP in a supervised
+child that is killed on overrun (aed_budget); the recordings left
+unprocessed, for whatever reason, are listed in detection/<job>/
+<job>_failed.json for a later retry.
+AED_SHM_SLOTS splits the pipeline's compute stage into decode and detect
+processes that pass spectrograms through shared memory (aed_shm).
+
+Daemon mode replaces the one-process-per-job launch:
+
+    python3 aed_run_job.py --daemon [--concurrency K] [--poll SEC]
+
+polls `jobs` for job_type_id 8 / state 'waiting', claims a job with a
+conditional waiting->initializing UPDATE and runs it with the engine,
+reflected tables, S3 resource and scientific imports kept warm between
+jobs (K jobs at a time, each in its own session and temp dir). SIGTERM
+stops the intake; jobs that have not finished stop at the next recording,
+drop their partial detections and go back to 'waiting'.
+
+S3: aed_lib is patched to honor S3_ENDPOINT (-> s3-proxy); a file:// RECBUCKET
+or WRITEBUCKET uses a mounted volume instead (aed_storage). DB: db.py
 falls back to env and uses ARBIMON_DB_USER.
 """
+import io
 import os
 import sys
 import json
 import shutil
+import time
+import argparse
+import contextlib
+import functools
 import datetime as dt
 
 import numpy as np
 import sqlalchemy as sqal
+from sqlalchemy.orm import Session
 
 from db import connect
+import aed_lib
 from aed_lib import (
-    find_events, compute_features, store_roi_images, download_and_get_spec,
-    to_unitcirc,
+    download_recording, discard_recording, get_spec, analyze_recording,
+    analyze_spectrogram, append_features, upload_roi_images, to_unitcirc,
 )
+from aed_sched import cost_columns, row_costs, pack, PER_RECORDING_COST
+from aed_metrics import Timer, JobMetrics
+import aed_cache
+import aed_cluster
+import aed_compact
+import aed_index
+import aed_budget
+import aed_profile
+import aed_shm
+from npy_append_array import NpyAppendArray
 
+JOB_TYPE_ID = 8  # "Audio Event Detection for Clustering"
 FILT_PCTL = 0.95
 TEMP_DIR = "/tmp/temp/"
 
-def _fresh():
-    if os.path.exists(TEMP_DIR):
-        shutil.rmtree(TEMP_DIR)
-    for d in (TEMP_DIR, TEMP_DIR + "/recordings/", TEMP_DIR + "/images",
-              TEMP_DIR + "/detection_data/"):
-        os.makedirs(d, exist_ok=True)
+class JobInterrupted(Exception):
+    # raised between recordings once a daemon's stop event is set
+    pass
 
-def main(job_id):
-    import boto3
-    s3 = boto3.resource("s3", endpoint_url=os.environ.get("S3_ENDPOINT") or None)
+def _work_dir(job_id):
+    # per-job scratch dir, so a daemon can run several jobs side by side
+    return TEMP_DIR + f"job_{job_id}/"
 
-    session, engine, metadata = connect()
-    recordings = sqal.Table('recordings', metadata, autoload=True, autoload_with=engine)
-    aeds = sqal.Table('audio_event_detections_clustering', metadata, autoload=True, autoload_with=engine)
-    playlist_aed = sqal.Table('playlist_aed', metadata, autoload=True, autoload_with=engine)
-    jobs = sqal.Table('jobs', metadata, autoload=True, autoload_with=engine)
-    jparams = sqal.Table('job_params_audio_event_detection_clustering', metadata, autoload=True, autoload_with=engine)
+def _fresh(work):
+    if os.path.exists(work):
+        shutil.rmtree(work)
+    for d in (work, work + "recordings/"):
+        os.makedirs(d, exist_ok=True)
+
+def _tables(engine, metadata):
+    return {name: sqal.Table(name, metadata, autoload=True, autoload_with=engine)
+            for name in ('recordings', 'audio_event_detections_clustering',
+                         'playlist_aed', 'jobs', 'playlist_recordings',
+                         'job_params_audio_event_detection_clustering')}
 
+def _job_params(session, T, job_id):
+    jparams = T['job_params_audio_event_detection_clustering']
     jp = session.execute(
         sqal.select([jparams.c.playlist_id, jparams.c.project_id, jparams.c.parameters])
         .where(jparams.c.job_id == job_id)
     ).fetchall()
     if not jp:
-        _fail(session, jobs, job_id, "No job_params_audio_event_detection_clustering row")
-        return 1
-    plist_id, proj_id, params_json = int(jp[0][0]), jp[0][1], jp[0][2]
-    p = json.loads(params_json) if params_json else {}
-    amp = float(p.get("Amplitude Threshold", 0))
-    dur = float(p.get("Duration Threshold", 0))
-    bw = float(p.get("Bandwidth Threshold", 0))
-    area = float(p.get("Area Threshold", 0))
-    filt = int(p.get("Filter Size", 1))
-    print(f"AED job_id={job_id} playlist={plist_id} proj={proj_id} "
-          f"amp={amp} dur={dur} bw={bw} area={area} filt={filt}")
-
-    session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
-        state='processing', last_update=dt.datetime.now()))
-    session.commit()
+        return None
+    p = json.loads(jp[0][2]) if jp[0][2] else {}
+    return int(jp[0][0]), jp[0][1], p
 
-    rec_rows = session.execute(
-        sqal.select([recordings.c.recording_id, recordings.c.uri, recordings.c.datetime])
+def _playlist_recordings(session, T, plist_id):
+    # (recording_id, uri, datetime, <aed_sched cost columns...>) rows
+    recordings, plist_recs = T['recordings'], T['playlist_recordings']
+    return session.execute(
+        sqal.select([recordings.c.recording_id, recordings.c.uri, recordings.c.datetime]
+                    + cost_columns(recordings))
         .select_from(recordings.join(
-            sqal.Table('playlist_recordings', metadata, autoload=True, autoload_with=engine),
-            recordings.c.recording_id == sqal.literal_column('playlist_recordings.recording_id')))
-        .where(sqal.literal_column('playlist_recordings.playlist_id') == plist_id)
+            plist_recs, recordings.c.recording_id == plist_recs.c.recording_id))
+        .where(plist_recs.c.playlist_id == plist_id)
         .order_by(recordings.c.recording_id)
     ).fetchall()
-    rec_ids = [int(r[0]) for r in rec_rows]
-    rec_uris = [r[1] for r in rec_rows]
-    rec_dts_raw = [r[2] for r in rec_rows]
-    total = len(rec_ids)
-    print(f"playlist has {total} recordings")
+
+def shard_rows(T, rows, index, count):
+    # Deterministic split of the recording_id-ordered playlist into `count`
+    # parts of even estimated cost (aed_sched, same packing as the conductor's
+    # Lambda chunks), so the reduce step can recompute who owned what.
+    names = [c.name for c in cost_columns(T['recordings'])]
+    return [rows[i] for i in pack(row_costs(rows, names, 3), count)[index]]
+
+def _aed_args(p):
+    # job parameters -> the threshold / event cap / band / mode arguments of
+    # aed_lib.analyze_recording ("Max Events" 0 or unset: no cap; "Min /
+    # Max Frequency" in kHz like the bandwidth threshold, 0 or unset: full band)
+    return (int(p.get("Filter Size", 1)), FILT_PCTL,
+            float(p.get("Amplitude Threshold", 0)),
+            float(p.get("Bandwidth Threshold", 0)),
+            float(p.get("Duration Threshold", 0)),
+            float(p.get("Area Threshold", 0)),
+            int(p.get("Max Events") or 0),
+            str(p.get("Event Rank") or "energy").lower(),
+            float(p.get("Min Frequency") or 0) * 1000,
+            float(p.get("Max Frequency") or 0) * 1000,
+            str(p.get("Detection Mode") or "exact").lower())
+
+def _max_samplerate(T, rows):
+    # highest sample_rate of the playlist rows, or 0 unless every row has one
+    names = [c.name for c in cost_columns(T['recordings'])]
+    if 'sample_rate' not in names or not rows:
+        return 0
+    rates = [float(r[3 + names.index('sample_rate')] or 0) for r in rows]
+    return 0 if min(rates) <= 0 else max(rates)
+
+def _build_index(p):
+    # "Build Index": 1 / true -> nearest-neighbour index at job end (aed_index)
+    return str(p.get("Build Index") or "").lower() in ("1", "true", "yes")
+
+def _cap_remark(p, dropped):
+    # job remark telling users the per-recording event cap truncated output
+    if not dropped:
+        return None
+    return (f"{dropped} events dropped by the cap of {int(p.get('Max Events') or 0)} "
+            f"per recording (ranked by {str(p.get('Event Rank') or 'energy').lower()})")
+
+def _rec_dt(d):
+    # datetime -> unit circle (None-safe; many recs have 0000-00-00 -> None)
+    return to_unitcirc(((d.hour + d.minute / 60) / 24) if d else 0.0)
+
+def _store(session, T, job_id, rec_id, res, feature_prefix, timer, cluster=None):
+    # detections -> DB, feature block -> local feature files (and the
+    # streaming k-means, if the job clusters)
+    if not res['boxes']:
+        return
+    with timer.stage('db_insert'):
+        _insert_detections(session, T, job_id, rec_id, res)
+    with timer.stage('feature_write'):
+        append_features(feature_prefix, res['features'], res['ids'])
+    if cluster is not None:
+        with timer.stage('cluster'):
+            cluster.add(res['features'])
+
+def _insert_detections(session, T, job_id, rec_id, res):
+    session.execute(T['audio_event_detections_clustering'].insert(), [{
+        'job_id': int(job_id), 'recording_id': rec_id,
+        'time_min': b[0], 'time_max': b[1],
+        'frequency_min': b[2], 'frequency_max': b[3],
+        # uri_vector: mysql2pg B1, real NOT-NULL col (was phantom uri_image).
+        # uri_param: the clustering UI builds the ROI PNG URL from
+        # this column (CONCAT ... uri_param, '.png'); PNGs are keyed
+        # by aed_number, so uri_param = aed_number. NULL => blank
+        # ROI grid (2026-07-18 user-reported regression fix).
+        'aed_number': int(c), 'uri_vector': '', 'uri_param': int(c),
+    } for c, b in enumerate(res['boxes'])])
+    session.commit()
+
+def _progress(session, T, job_id, n, incremental):
+    # `incremental` bumps the shared job progress counter (several shards
+    # update the same job row) instead of setting it to the local position.
+    jobs = T['jobs']
     session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
-        progress=0, progress_steps=max(total, 1)))
+        progress=jobs.c.progress + 1 if incremental else n,
+        last_update=dt.datetime.now()))
     session.commit()
 
-    # datetime -> unit circle (None-safe; many recs have 0000-00-00 -> None)
-    rec_dts = []
-    for d in rec_dts_raw:
-        frac = ((d.hour + d.minute / 60) / 24) if d else 0.0
-        rec_dts.append(to_unitcirc(frac))
-
-    _fresh()
-    rec_dir = TEMP_DIR + "/recordings/"
-    image_dir = TEMP_DIR + "/images"
-    feature_prefix = TEMP_DIR + "/" + str(job_id) + "_0"
+def _metrics(job_id, feature_prefix):
+    # per-recording JSON lines next to the feature files (uploaded with
+    # them); AED_PROM_TEXTFILE adds a live Prometheus textfile
+    return JobMetrics(job_id, feature_prefix + "_metrics.jsonl",
+                      os.environ.get("AED_PROM_TEXTFILE") or None)
+
+def _process(session, T, job_id, rec_rows, p, feature_prefix, env, incremental=False,
+             stop=None, cluster=None):
+    # Runs AED over rec_rows, writing detections + local feature files and
+    # <feature_prefix>_metrics.jsonl, feeding each feature block to
+    # `cluster` (aed_cluster) if given. Returns the number of unprocessed
+    # recordings and the closed JobMetrics (failure list, dropped events). Raises
+    # JobInterrupted if `stop` (a threading.Event) gets set before every
+    # recording was processed.
+    metrics = _metrics(job_id, feature_prefix)
+    try:
+        if os.environ.get("AED_PIPELINE", "").lower() == "async":
+            unprocessed = _process_pipelined(session, T, job_id, rec_rows, p, feature_prefix,
+                                             env, metrics, incremental, stop, cluster)
+        else:
+            unprocessed = _process_serial(session, T, job_id, rec_rows, p, feature_prefix,
+                                          env, metrics, incremental, stop, cluster)
+    finally:
+        print("AED metrics:", json.dumps(metrics.close()))
+    return unprocessed, metrics
+
+def _analyze(budget, path, rec_id, rec_dt, args, timer, profile=None):
+    return _supervised(budget, timer, analyze_recording, path, rec_id, rec_dt, *args,
+                       profile=profile)
+
+def _profiling(budget, profile):
+    # profiler.recording() around a block run in this process, for `profile`
+    # (profiler, n, name, out); with a budget the DSP runs in aed_budget's
+    # child instead, and _supervised profiles it there
+    if budget is not None:
+        return contextlib.nullcontext()
+    profiler, n, name, out = profile
+    return profiler.recording(n, name, out)
+
+def _supervised(budget, timer, fn, *a, profile=None):
+    # fn(*a, timer=timer), in a supervised child when AED_REC_TIMEOUT /
+    # AED_REC_MAXMEM set a budget (aed_budget). The DSP imports are lazy:
+    # load them here once, so the forked children inherit them instead of
+    # each importing them again on the recording's clock. `profile`
+    # (profiler, n, name, out) runs the profiler inside the child and adds
+    # its files to `out`.
+    if budget is None:
+        return fn(*a, timer=timer)
+    aed_lib.preload()
+    with timer.stage('supervise'):
+        res, stages, prof = budget.run(_timed_child, fn, a, profile)
+    timer.stages['supervise'] -= sum(stages.values())
+    for name, sec in stages.items():
+        timer.stages[name] = timer.stages.get(name, 0.0) + sec
+    if prof:
+        profile[3].update(prof)
+    return res
+
+def _timed_child(fn, a, profile):
+    timer, out = Timer(), {}
+    with (profile[0].recording(profile[1], profile[2], out) if profile
+          else contextlib.nullcontext()):
+        res = fn(*a, timer=timer)
+    return res, timer.stages, out
+
+def _process_serial(session, T, job_id, rec_rows, p, feature_prefix, env, metrics, incremental,
+                    stop=None, cluster=None):
+    args = _aed_args(p)
+    cache = aed_cache.from_env(args)
+    budget = aed_budget.from_env()
+    profiler = aed_profile.from_env()
+    rec_dir = os.path.dirname(feature_prefix) + "/recordings/"
     recbucket = os.environ.get("RECBUCKET", "rfcx-streams-production")
-    writebucket = os.environ.get("WRITEBUCKET", "arbimon2")
-    env = os.environ.get("AWS_SECRET", "prod").lower()
 
     unprocessed = 0
-    any_features = False
-    for n, rec in enumerate(rec_uris):
+    for n, r in enumerate(rec_rows):
+        if stop is not None and stop.is_set():
+            raise JobInterrupted(f"stopped after {n} of {len(rec_rows)} recordings")
+        rec_id, rec, d = int(r[0]), r[1], r[2]
+        timer, res, cached, error, prof = Timer(), None, False, None, {}
         try:
-            image_uri = f"audio_events/{env}/detection/{job_id}/png/{rec_ids[n]}/"
-            os.makedirs(image_dir + "/" + str(rec_ids[n]), exist_ok=True)
-            f, t, S = download_and_get_spec(rec, recbucket, rec_dir)
-            objs = find_events(S, f, t, filt, FILT_PCTL, amp, bw, dur, area)
-            if len(objs) > 0:
-                session.execute(aeds.insert(), [{
-                    'job_id': int(job_id), 'recording_id': int(rec_ids[n]),
-                    'time_min': float(t[ob[1].start]), 'time_max': float(t[ob[1].stop - 1]),
-                    'frequency_min': float(f[ob[0].start]), 'frequency_max': float(f[ob[0].stop - 1]),
-                    # uri_vector: mysql2pg B1, real NOT-NULL col (was phantom uri_image).
-                    # uri_param: the clustering UI builds the ROI PNG URL from
-                    # this column (CONCAT ... uri_param, '.png'); PNGs are keyed
-                    # by aed_number, so uri_param = aed_number. NULL => blank
-                    # ROI grid (2026-07-18 user-reported regression fix).
-                    'aed_number': int(c), 'uri_vector': '', 'uri_param': int(c),
-                } for c, ob in enumerate(objs)])
-                session.commit()
-                compute_features(objs, rec_ids[n], rec_dts[n], S, f, t, feature_prefix)
-                store_roi_images(S, objs, rec_ids[n], image_dir, image_uri)
-                any_features = True
+            with _profiling(budget, (profiler, n, rec_id, prof)):
+                if cache:
+                    with timer.stage('cache'):
+                        res = cache.get(rec, rec_id, _rec_dt(d))
+                    cached = res is not None
+                if res is None:
+                    path = download_recording(rec, recbucket, rec_dir, timer)
+                    try:
+                        res = _analyze(budget, path, rec_id, _rec_dt(d), args, timer,
+                                       (profiler, n, rec_id, prof))
+                    finally:
+                        discard_recording(path, rec_dir)
+                    if cache:
+                        with timer.stage('cache'):
+                            cache.put(rec, res)
+                _store(session, T, job_id, rec_id, res, feature_prefix, timer, cluster)
+                upload_roi_images(res['pngs'], f"audio_events/{env}/detection/{job_id}/png/{rec_id}/",
+                                  timer)
         except Exception as e:
             print("unprocessed:", rec, e)
             unprocessed += 1
+            error = e
         finally:
-            session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
-                progress=n + 1, last_update=dt.datetime.now()))
-            session.commit()
+            _progress(session, T, job_id, n + 1, incremental)
+            metrics.record(rec_id, rec, timer.stages, len(res['boxes']) if res else 0,
+                           error, cached, res.get('dropped', 0) if res else 0)
+            _upload_profile(prof, job_id, env)
+    if cache:
+        print(f"result cache: {cache.hits} hits, {cache.misses} misses")
+    return unprocessed
 
-    # map aed_ids + write playlist_aed + upload feature files (only if any)
-    if any_features and os.path.exists(feature_prefix + "_ids.npy"):
-        rows = session.execute(
-            sqal.select([aeds.c.aed_id, aeds.c.recording_id, aeds.c.aed_number])
-            .where(sqal.and_(aeds.c.job_id == job_id, aeds.c.recording_id.in_(rec_ids)))
-        ).fetchall()
-        key = {tuple(r[1:]): r[0] for r in rows}
-        aed_ids = np.load(feature_prefix + "_ids.npy")
-        aed_ids = [int(key[tuple(i)]) for i in aed_ids]
-        np.save(feature_prefix + "_ids.npy", aed_ids)
-        if aed_ids:
-            session.execute(playlist_aed.insert(),
-                            [{'playlist_id': plist_id, 'aed_id': a} for a in aed_ids])
-            session.commit()
-        for suffix in ("_features.npy", "_ids.npy"):
-            fp = feature_prefix + suffix
-            if os.path.exists(fp):
-                s3.Bucket(writebucket).upload_file(
-                    fp, f"audio_events/{env}/detection/{job_id}/{job_id}_0{suffix}")
+def _upload_profile(prof, job_id, env):
+    # profiles of sampled recordings (aed_profile) -> detection/<job>/profiles/
+    if not prof:
+        return
+    try:
+        aed_profile.upload(prof, os.environ.get("WRITEBUCKET", "arbimon2"),
+                           f"audio_events/{env}/detection/{job_id}/profiles/")
+    except Exception as e:
+        print("profile upload failed:", e)
+
+def _compute(args, profiler, budget, rec_dir, item):
+    # process-pool stage: decode + STFT + detection + features + PNGs
+    if 'result' in item:
+        return item  # result cache hit
+    try:
+        profile = (profiler, item['n'], item['rec_id'], item['profile'])
+        with _profiling(budget, profile):
+            item['result'] = _analyze(budget, item['path'], item['rec_id'], item['rec_dt'],
+                                      args, item['timer'], profile)
+    finally:
+        discard_recording(item['path'], rec_dir)
+    return item
+
+def _decode(args, profiler, budget, ring, rec_dir, item):
+    # AED_SHM_SLOTS split compute, process stage 1: decode + STFT into the
+    # item's shared-memory slot (aed_shm), supervised like the detection
+    if 'result' in item:
+        return item  # result cache hit
+    fmin, fmax = args[8], args[9]
+    try:
+        ring._buf(item['slot'])  # attach here: the budgeted child inherits the mapping
+        profile = (profiler, item['n'], f"{item['rec_id']}_decode", item['profile'])
+        with _profiling(budget, profile):
+            spec = _supervised(budget, item['timer'], _decode_to_slot, ring, item['slot'],
+                               item['path'], fmin, fmax, profile=profile)
+    finally:
+        discard_recording(item['path'], rec_dir)
+    item['spec'] = spec
+    if spec['inline']:
+        item['shm_inline'] = sum(a.nbytes for a in spec['inline'].values())
+    return item
+
+def _decode_to_slot(ring, slot, path, fmin, fmax, timer):
+    # get_spec written straight into the slot, so only the descriptor comes
+    # back (through aed_budget's pipe too)
+    f, t, S = get_spec(path, timer=timer, fmin=fmin, fmax=fmax)
+    return ring.put(slot, {'f': f, 't': t, 'S': S})
+
+def _detect(args, profiler, budget, ring, item):
+    # process stage 2: detection + features + PNGs on zero-copy views of the slot
+    if 'result' in item:
+        return item
+    filt, pctl, amp, bw, dur, area, max_events, rank, _, _, mode = args
+    spec = ring.view(item.pop('spec'))
+    profile = (profiler, item['n'], item['rec_id'], item['profile'])
+    with _profiling(budget, profile):
+        item['result'] = _supervised(budget, item['timer'], analyze_spectrogram,
+                                     spec['f'], spec['t'], spec['S'], item['rec_id'],
+                                     item['rec_dt'], filt, pctl, amp, bw, dur, area,
+                                     max_events, rank, mode, profile=profile)
+    return item
+
+def _process_pipelined(session, T, job_id, rec_rows, p, feature_prefix, env, metrics, incremental,
+                       stop=None, cluster=None):
+    # AED_PIPELINE=async: same work as _process, as an asyncio staged
+    # pipeline (aed_pipeline) so S3 fetches, CPU-bound detection, PNG
+    # uploads and DB writes overlap. Stage widths come from
+    # AED_FETCH_WORKERS / AED_COMPUTE_WORKERS / AED_UPLOAD_WORKERS; the DB
+    # stage is always one thread (one session). PNGs are uploaded before
+    # the detection rows are written, so a recording whose upload fails
+    # leaves no rows behind. With AED_SHM_SLOTS the compute stage is split
+    # into decode and detect processes (AED_DECODE_WORKERS) that hand the
+    # spectrogram over through a shared-memory ring (aed_shm).
+    from aed_pipeline import Pipeline, Stage
+    rec_dir = os.path.dirname(feature_prefix) + "/recordings/"
+    recbucket = os.environ.get("RECBUCKET", "rfcx-streams-production")
+    cache = aed_cache.from_env(_aed_args(p))
+    names = [c.name for c in cost_columns(T['recordings'])]
+    ring = aed_shm.from_env(max(row_costs(rec_rows, names, 3) or [0]) - PER_RECORDING_COST)
+    counts = {'done': 0, 'unprocessed': 0, 'shm_inline': 0}
+
+    # item['timer'] travels with the recording through every stage
+    # (including the compute process and back)
+    def fetch(item):
+        timer = item['timer'] = Timer()
+        res = None
+        if cache:
+            with timer.stage('cache'):
+                res = cache.get(item['uri'], item['rec_id'], item['rec_dt'])
+        if res is not None:
+            item['result'] = res
+        else:
+            item['path'] = download_recording(item['uri'], recbucket, rec_dir, timer)
+            if ring is not None:
+                with timer.stage('shm_wait'):
+                    item['slot'] = ring.acquire()
+        return item
+
+    def release(item):
+        # the detect stage is the slot's only consumer
+        if 'slot' in item:
+            ring.release(item.pop('slot'))
+
+    def upload(item):
+        release(item)
+        if cache and 'path' in item:
+            with item['timer'].stage('cache'):
+                cache.put(item['uri'], item['result'])
+        upload_roi_images(item['result'].pop('pngs'),
+                          f"audio_events/{env}/detection/{job_id}/png/{item['rec_id']}/",
+                          item['timer'])
+        return item
+
+    def store(item):
+        if 'skipped' in item:
+            # stopped: the job is requeued, so only give back its resources
+            release(item)
+            if os.path.exists(item.get('path') or ''):
+                discard_recording(item['path'], rec_dir)
+            return item
+        timer = item.get('timer') or Timer()
+        error = None
+        try:
+            if 'error' in item:
+                raise item['error']
+            _store(session, T, job_id, item['rec_id'], item['result'], feature_prefix, timer,
+                   cluster)
+        except Exception as e:
+            print("unprocessed:", item['uri'], e)
+            counts['unprocessed'] += 1
+            error = e
+        finally:
+            release(item)
+            if item.get('shm_inline'):
+                counts['shm_inline'] += 1
+                print(f"shm: {item['uri']} spectrogram did not fit a "
+                      f"{ring.slot_bytes / 2**20:.0f} MB slot, "
+                      f"{item['shm_inline'] / 2**20:.0f} MB passed inline")
+            counts['done'] += 1
+            _progress(session, T, job_id, counts['done'], incremental)
+            res = item.get('result')
+            metrics.record(item['rec_id'], item['uri'], timer.stages,
+                           len(res['boxes']) if res else 0, error,
+                           'result' in item and 'path' not in item,
+                           res.get('dropped', 0) if res else 0)
+            _upload_profile(item['profile'], job_id, env)
+        return item
+
+    env_int = lambda name, default: int(os.environ.get(name) or default)
+    args, profiler, budget = _aed_args(p), aed_profile.from_env(), aed_budget.from_env()
+    compute_workers = env_int("AED_COMPUTE_WORKERS", os.cpu_count() or 1)
+    if ring is None:
+        compute = [Stage('compute', functools.partial(_compute, args, profiler, budget, rec_dir),
+                         compute_workers, kind='process')]
+    else:
+        compute = [Stage('decode', functools.partial(_decode, args, profiler, budget, ring, rec_dir),
+                         env_int("AED_DECODE_WORKERS", max(compute_workers // 2, 1)),
+                         kind='process'),
+                   Stage('detect', functools.partial(_detect, args, profiler, budget, ring),
+                         compute_workers, kind='process')]
+    pipeline = Pipeline([Stage('fetch', fetch, env_int("AED_FETCH_WORKERS", 4))] + compute + [
+        Stage('upload', upload, env_int("AED_UPLOAD_WORKERS", 4)),
+        Stage('store', store, 1, errors=True),
+    ], queue_size=env_int("AED_QUEUE_SIZE", 4), stop=stop)
+    def items():
+        for n, r in enumerate(rec_rows):
+            if stop is not None and stop.is_set():
+                return  # recordings in flight drain as 'skipped'
+            yield {'n': n, 'rec_id': int(r[0]), 'uri': r[1], 'rec_dt': _rec_dt(r[2]),
+                   'profile': {}}
+
+    try:
+        pipeline.run(items())
+    finally:
+        if ring is not None:
+            ring.close()
+    stats = pipeline.stats()
+    if ring is not None:
+        stats['shm'] = {'slots': len(ring), 'slot_mb': round(ring.slot_bytes / 2**20, 1),
+                        'inline': counts['shm_inline']}
+    print("pipeline stages:", json.dumps(stats))
+    if cache:
+        print(f"result cache: {cache.hits} hits, {cache.misses} misses")
+    if counts['done'] < len(rec_rows):
+        raise JobInterrupted(f"stopped after {counts['done']} of {len(rec_rows)} recordings")
+    return counts['unprocessed']
+
+def _publish_features(session, T, s3, job_id, plist_id, rec_ids, feature_prefix, env,
+                      compact=None, index=False):
+    # map aed_ids + write playlist_aed + upload feature files (only if any),
+    # plus the compact meta / hog / reduced files when `compact` is set and
+    # the nearest-neighbour index with `index`
+    aeds, playlist_aed = T['audio_event_detections_clustering'], T['playlist_aed']
+    if not os.path.exists(feature_prefix + "_ids.npy"):
+        return
+    writebucket = os.environ.get("WRITEBUCKET", "arbimon2")
+    rows = session.execute(
+        sqal.select([aeds.c.aed_id, aeds.c.recording_id, aeds.c.aed_number])
+        .where(sqal.and_(aeds.c.job_id == job_id, aeds.c.recording_id.in_(rec_ids)))
+    ).fetchall()
+    key = {tuple(r[1:]): r[0] for r in rows}
+    aed_ids = np.load(feature_prefix + "_ids.npy")
+    aed_ids = [int(key[tuple(i)]) for i in aed_ids]
+    np.save(feature_prefix + "_ids.npy", aed_ids)
+    if aed_ids:
+        session.execute(playlist_aed.insert(),
+                        [{'playlist_id': plist_id, 'aed_id': a} for a in aed_ids])
+        session.commit()
+    suffixes = ["_features.npy", "_ids.npy", "_clusters.npy", "_centroids.npy"]
+    if compact is not None and os.path.exists(feature_prefix + "_features.npy"):
+        t0 = time.perf_counter()
+        suffixes += compact.write(feature_prefix)
+        print(f"compact features ({compact.dtype}, {compact.reduction}): "
+              f"{time.perf_counter() - t0:.1f}s")
+    if index and aed_ids:
+        t0 = time.perf_counter()
+        suffix = aed_index.build_for_job(feature_prefix)
+        if suffix:
+            suffixes.append(suffix)
+        print(f"feature index over {len(aed_ids)} events: {time.perf_counter() - t0:.1f}s")
+    for suffix in suffixes:
+        fp = feature_prefix + suffix
+        if os.path.exists(fp):
+            s3.Bucket(writebucket).upload_file(
+                fp, f"audio_events/{env}/detection/{job_id}/{job_id}_0{suffix}")
 
+def _finish(session, T, job_id, total, unprocessed, remark=None):
+    jobs = T['jobs']
     state = 'completed'
-    remark = None
     if total and unprocessed / total >= 0.5:
         state = 'error'
         remark = f"{round(unprocessed*100/total)}% of recordings could not be processed"
@@ -172,19 +584,342 @@ def main(job_id):
         state=state, completed=(1 if state == 'completed' else -1),
         progress=max(total, 1), remarks=remark, last_update=dt.datetime.now()))
     session.commit()
-    session.close()
-    engine.dispose()
     print(f"AED job {job_id} {state}: total={total} unprocessed={unprocessed}")
     return 0 if state == 'completed' else 1
 
+def _s3():
+    # the S3_ENDPOINT / file:// aware storage aed_lib already holds (one
+    # resource per process, and one place for the benchmark's local
+    # stand-in to replace)
+    return aed_lib.s3
+
+def main(job_id, shard=None):
+    session, engine, metadata = connect()
+    try:
+        return run_job(session, _tables(engine, metadata), job_id, shard)
+    finally:
+        session.close()
+        engine.dispose()
+
+def run_job(session, T, job_id, shard=None, stop=None):
+    # One job (or one shard of it) on an open session / reflected tables.
+    s3 = _s3()
+    jobs = T['jobs']
+
+    jp = _job_params(session, T, job_id)
+    if jp is None:
+        _fail(session, jobs, job_id, "No job_params_audio_event_detection_clustering row")
+        return 1
+    plist_id, proj_id, p = jp
+    if str(p.get("Event Rank") or "energy").lower() not in aed_lib.EVENT_RANKS:
+        _fail(session, jobs, job_id, f"Unknown Event Rank {p.get('Event Rank')!r}")
+        return 1
+    if str(p.get("Detection Mode") or "exact").lower() not in aed_lib.DETECTION_MODES:
+        _fail(session, jobs, job_id, f"Unknown Detection Mode {p.get('Detection Mode')!r}")
+        return 1
+    args = _aed_args(p)
+    try:
+        aed_lib.check_band(args[8], args[9])
+        compact = aed_compact.from_params(p)
+        cluster = aed_cluster.from_params(p)
+    except ValueError as e:
+        _fail(session, jobs, job_id, str(e))
+        return 1
+    print(f"AED job_id={job_id} playlist={plist_id} proj={proj_id} "
+          f"shard={'%d/%d' % shard if shard else '-'} params={p}")
+
+    session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
+        state='processing', last_update=dt.datetime.now()))
+    session.commit()
+
+    rec_rows = _playlist_recordings(session, T, plist_id)
+    total = len(rec_rows)
+    print(f"playlist has {total} recordings")
+    try:
+        aed_lib.check_band(args[8], args[9], _max_samplerate(T, rec_rows))
+    except ValueError as e:
+        _fail(session, jobs, job_id, str(e))
+        return 1
+    if shard is None:
+        session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
+            progress=0, progress_steps=max(total, 1)))
+    else:
+        # shards start at different times: never reset the shared counter
+        session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
+            progress_steps=max(total, 1)))
+    session.commit()
+
+    env = os.environ.get("AWS_SECRET", "prod").lower()
+    work = _work_dir(job_id)
+    _fresh(work)
+
+    if shard is not None:
+        index, count = shard
+        mine = shard_rows(T, rec_rows, index, count)
+        mine_ids = [int(r[0]) for r in mine]
+        print(f"shard {index}/{count}: {len(mine)} recordings")
+        # a retried pod must not duplicate the detections of its failed attempt
+        aeds = T['audio_event_detections_clustering']
+        if mine_ids:
+            session.execute(aeds.delete().where(sqal.and_(
+                aeds.c.job_id == job_id, aeds.c.recording_id.in_(mine_ids))))
+            session.commit()
+        feature_prefix = work + f"{job_id}_{index}"
+        unprocessed, metrics = _process(session, T, job_id, mine, p, feature_prefix, env,
+                                        incremental=True, stop=stop)
+        _upload_shard(s3, job_id, index, count, len(mine), unprocessed, metrics,
+                      feature_prefix, env)
+        print(f"AED job {job_id} shard {index}/{count} done: "
+              f"total={len(mine)} unprocessed={unprocessed}")
+        return 0
+
+    rec_ids = [int(r[0]) for r in rec_rows]
+    feature_prefix = work + str(job_id) + "_0"
+    unprocessed, metrics = _process(session, T, job_id, rec_rows, p, feature_prefix, env,
+                                    stop=stop, cluster=cluster)
+    if cluster is not None:
+        cluster.write(feature_prefix)
+    _publish_features(session, T, s3, job_id, plist_id, rec_ids, feature_prefix, env, compact,
+                      _build_index(p))
+    s3.Bucket(os.environ.get("WRITEBUCKET", "arbimon2")).upload_file(
+        feature_prefix + "_metrics.jsonl",
+        f"audio_events/{env}/detection/{job_id}/{job_id}_0_metrics.jsonl")
+    _upload_failed(s3, job_id, metrics.failed, env)
+    return _finish(session, T, job_id, total, unprocessed, _cap_remark(p, metrics.dropped))
+
+def _shard_key(env, job_id, index, suffix):
+    return f"audio_events/{env}/detection/{job_id}/shards/{job_id}_{index}{suffix}"
+
+def _upload_failed(s3, job_id, failed, env):
+    # recordings left unprocessed (errors, budget overruns, missing shards)
+    # -> detection/<job>/<job>_failed.json, for a later retry
+    if not failed:
+        return
+    s3.Bucket(os.environ.get("WRITEBUCKET", "arbimon2")).upload_fileobj(
+        io.BytesIO(json.dumps(failed).encode("utf-8")),
+        f"audio_events/{env}/detection/{job_id}/{job_id}_failed.json")
+
+def _upload_shard(s3, job_id, index, count, total, unprocessed, metrics, feature_prefix, env):
+    bucket = s3.Bucket(os.environ.get("WRITEBUCKET", "arbimon2"))
+    for suffix in ("_features.npy", "_ids.npy", "_metrics.jsonl"):
+        fp = feature_prefix + suffix
+        if os.path.exists(fp):
+            bucket.upload_file(fp, _shard_key(env, job_id, index, suffix))
+    status = {'shard': index, 'shards': count, 'total': total,
+              'unprocessed': unprocessed, 'failed': metrics.failed,
+              'dropped': metrics.dropped,
+              'features': os.path.exists(feature_prefix + "_ids.npy")}
+    with open(feature_prefix + "_status.json", "w") as fp:
+        json.dump(status, fp)
+    # status goes last: its presence tells the reduce step the shard finished
+    bucket.upload_file(feature_prefix + "_status.json",
+                       _shard_key(env, job_id, index, "_status.json"))
+
+def reduce(job_id, count):
+    session, engine, metadata = connect()
+    try:
+        return _reduce(session, _tables(engine, metadata), job_id, count)
+    finally:
+        session.close()
+        engine.dispose()
+
+def _reduce(session, T, job_id, count):
+    s3 = _s3()
+    jobs = T['jobs']
+
+    jp = _job_params(session, T, job_id)
+    if jp is None:
+        _fail(session, jobs, job_id, "No job_params_audio_event_detection_clustering row")
+        return 1
+    plist_id, p = jp[0], jp[2]
+    rec_rows = _playlist_recordings(session, T, plist_id)
+    total = len(rec_rows)
+    env = os.environ.get("AWS_SECRET", "prod").lower()
+    bucket = s3.Bucket(os.environ.get("WRITEBUCKET", "arbimon2"))
+    work = _work_dir(job_id)
+    _fresh(work)
+
+    feature_prefix = work + str(job_id) + "_0"
+    unprocessed, failed, dropped, missing_ids = 0, [], 0, []
+    for index in range(count):
+        shard_prefix = work + "shard_" + str(index)
+        blocks = {}
+        try:
+            bucket.download_file(_shard_key(env, job_id, index, "_status.json"),
+                                 shard_prefix + "_status.json")
+            with open(shard_prefix + "_status.json") as fp:
+                status = json.load(fp)
+            if int(status.get('shards', count)) == count and status['features']:
+                # fetch both files before appending either, so a shard that
+                # fails here leaves no rows behind
+                for suffix in ("_features.npy", "_ids.npy"):
+                    bucket.download_file(_shard_key(env, job_id, index, suffix),
+                                         shard_prefix + suffix)
+                    blocks[suffix] = np.ascontiguousarray(np.load(shard_prefix + suffix))
+                    os.remove(shard_prefix + suffix)
+        except Exception as e:
+            missing = shard_rows(T, rec_rows, index, count)
+            print(f"shard {index}/{count} missing ({e}); {len(missing)} recordings unprocessed")
+            unprocessed += len(missing)
+            failed += [{'recording_id': int(r[0]), 'uri': r[1], 'error': f"shard {index} missing"}
+                       for r in missing]
+            missing_ids += [int(r[0]) for r in missing]
+            continue
+        if int(status.get('shards', count)) != count:
+            # the split depends on N: merging another N's shards would mark
+            # the wrong recordings missing
+            _fail(session, jobs, job_id,
+                  f"shard {index} ran as one of {status['shards']} shards, not {count}")
+            return 1
+        unprocessed += int(status['unprocessed'])
+        failed += status.get('failed', [])
+        dropped += int(status.get('dropped', 0))
+        for suffix, block in blocks.items():
+            NpyAppendArray(feature_prefix + suffix).append(block)
+
+    if missing_ids:
+        # a shard that died mid-run may have written detections whose
+        # features never arrived: drop them, as the shard does on retry
+        aeds = T['audio_event_detections_clustering']
+        session.execute(aeds.delete().where(sqal.and_(
+            aeds.c.job_id == job_id, aeds.c.recording_id.in_(missing_ids))))
+        session.commit()
+
+    cluster = aed_cluster.from_params(p)
+    if cluster is not None and os.path.exists(feature_prefix + "_features.npy"):
+        aed_cluster.fit_file(cluster, feature_prefix)
+
+    rec_ids = [int(r[0]) for r in rec_rows]
+    _publish_features(session, T, s3, job_id, plist_id, rec_ids, feature_prefix, env,
+                      aed_compact.from_params(p), _build_index(p))
+    _upload_failed(s3, job_id, failed, env)
+    return _finish(session, T, job_id, total, unprocessed, _cap_remark(p, dropped))
+
 def _fail(session, jobs, job_id, msg):
     print("FAIL:", msg)
     session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
         state='error', completed=-1, remarks=msg[:500], last_update=dt.datetime.now()))
     session.commit()
 
+def _claim(engine, jobs):
+    # Flip the oldest waiting AED job to 'initializing' and return its id, or
+    # None. The conditional UPDATE makes the claim atomic across daemons and
+    # the dispatcher: whoever changes the row first owns the job.
+    with engine.begin() as conn:
+        ids = [r[0] for r in conn.execute(
+            sqal.select([jobs.c.job_id])
+            .where(sqal.and_(jobs.c.job_type_id == JOB_TYPE_ID, jobs.c.state == 'waiting'))
+            .order_by(jobs.c.job_id).limit(10))]
+    for job_id in ids:
+        with engine.begin() as conn:
+            res = conn.execute(jobs.update().where(sqal.and_(
+                jobs.c.job_id == job_id, jobs.c.state == 'waiting')).values(
+                    state='initializing', last_update=dt.datetime.now()))
+        if res.rowcount == 1:
+            return int(job_id)
+    return None
+
+def _requeue(session, T, job_id):
+    # hand an interrupted job back: drop its partial detections, reset to waiting
+    aeds, jobs = T['audio_event_detections_clustering'], T['jobs']
+    session.execute(aeds.delete().where(aeds.c.job_id == job_id))
+    session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
+        state='waiting', progress=0, remarks=None, last_update=dt.datetime.now()))
+    session.commit()
+
+def _daemon_job(engine, T, job_id, stop):
+    session = Session(bind=engine)
+    try:
+        rc = run_job(session, T, job_id, stop=stop)
+        print(f"daemon: job {job_id} finished rc={rc}")
+    except JobInterrupted as e:
+        print(f"daemon: job {job_id} interrupted ({e}); requeued")
+        session.rollback()
+        _requeue(session, T, job_id)
+    except Exception as e:
+        session.rollback()
+        _fail(session, T['jobs'], job_id, f"{type(e).__name__}: {e}")
+    finally:
+        session.close()
+        shutil.rmtree(_work_dir(job_id), ignore_errors=True)
+
+def daemon(concurrency=1, poll=10.0):
+    # Drain waiting AED jobs until SIGTERM/SIGINT, up to `concurrency` at a
+    # time. The engine, reflected tables, S3 resource and the scipy/skimage
+    # imports stay warm across jobs; each job gets its own session.
+    import signal
+    import threading
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    stop = threading.Event()
+    def _stop(signum, frame):
+        print(f"daemon: signal {signum}, requeueing unfinished jobs")
+        stop.set()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    budget = aed_budget.from_env()
+    if budget is not None and concurrency > 1 and budget.timeout <= 0:
+        # children forked from one job thread can inherit a lock another
+        # thread held and hang; only a timeout would ever reap them
+        print("daemon: AED_REC_MAXMEM with --concurrency > 1 needs AED_REC_TIMEOUT as well")
+        return 2
+
+    session, engine, metadata = connect()
+    session.close()
+    T = _tables(engine, metadata)
+    _s3().meta  # build the S3 resource once, up front
+    if budget is not None:
+        aed_lib.preload()  # before the job threads start forking
+    print(f"daemon: polling every {poll}s, {concurrency} job(s) at a time")
+
+    running = set()
+    with ThreadPoolExecutor(concurrency) as pool:
+        while not stop.is_set():
+            job_id = None
+            if len(running) < concurrency:
+                try:
+                    job_id = _claim(engine, T['jobs'])
+                except Exception as e:
+                    print("daemon: claim failed:", e)
+            if job_id is not None:
+                print(f"daemon: claimed job {job_id}")
+                running.add(pool.submit(_daemon_job, engine, T, job_id, stop))
+                continue
+            if running:
+                done, running = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+                for f in done:
+                    if f.exception() is not None:
+                        print("daemon: job error:", f.exception())
+            else:
+                stop.wait(poll)
+        wait(running)
+    engine.dispose()
+    return 0
+
+def _shard_arg(s):
+    index, count = (int(x) for x in s.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index out of range: {s}")
+    return index, count
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("usage: aed_run_job.py <job_id>")
-        sys.exit(2)
-    sys.exit(main(int(sys.argv[1].strip("'"))))
\ No newline at end of file
+    ap = argparse.ArgumentParser(usage="aed_run_job.py <job_id> [--shard i/N | --reduce N]\n"
+                                       "       aed_run_job.py --daemon [--concurrency K] [--poll SEC]")
+    ap.add_argument("job_id", nargs="?", type=lambda s: int(s.strip("'")))
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--shard", type=_shard_arg, metavar="i/N")
+    mode.add_argument("--reduce", type=int, metavar="N")
+    mode.add_argument("--daemon", action="store_true")
+    ap.add_argument("--concurrency", type=int,
+                    default=int(os.environ.get("AED_DAEMON_CONCURRENCY", "1")))
+    ap.add_argument("--poll", type=float,
+                    default=float(os.environ.get("AED_DAEMON_POLL", "10")))
+    args = ap.parse_args()
+    if args.daemon:
+        sys.exit(daemon(max(args.concurrency, 1), args.poll))
+    if args.job_id is None:
+        ap.error("job_id is required unless --daemon is given")
+    if args.reduce is not None:
+        sys.exit(reduce(args.job_id, args.reduce))
+    sys.exit(main(args.job_id, shard=args.shard))
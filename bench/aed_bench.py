@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Offline AED benchmark.
+
+Generates a synthetic FLAC corpus (several lengths, sample rates and
+event densities: tone bursts and chirps over a noise floor), serves it
+through a local directory-backed S3 stand-in and a SQLite database, and
+measures:
+
+  stages  - download_and_get_spec, find_events, compute_features and
+            store_roi_images per recording (best of --repeat runs)
+  e2e     - aed_run_job.main() over the whole corpus as one playlist
+  recall  - find_events mode='coarse' against the exact path: events
+            matched at IoU >= 0.5, and the find_events speedup; fails
+            under --min-recall or --min-speedup
+  imports - time to import aed_run_job / aed_batch in a fresh interpreter;
+            fails over --import-budget or if scipy/skimage/PIL/boto3/
+            soundfile get loaded at import (--import-only runs just this)
+
+Nothing touches AWS or the production DB. Results are written as JSON;
+with --baseline the run fails (exit 1) when any stage's or the
+end-to-end throughput (audio seconds processed per wall second) drops
+more than --tolerance below the baseline, so a pull request can be
+compared with the main branch on the same machine:
+
+    python3 bench/aed_bench.py --out base.json              # on main
+    python3 bench/aed_bench.py --baseline base.json         # on the branch
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+# after the stdlib: functions/worker/secrets.py would shadow the stdlib
+# `secrets` numpy imports (the Dockerfile deletes it, the checkout has it)
+sys.path += [ROOT, os.path.join(ROOT, 'functions', 'worker')]
+
+import numpy as np
+import soundfile as sf
+
+RECBUCKET = 'bench-recordings'
+WRITEBUCKET = 'bench-artifacts'
+PARAMS = {'Amplitude Threshold': 1.5, 'Duration Threshold': 0.1,
+          'Bandwidth Threshold': 0.5, 'Area Threshold': 0.05, 'Filter Size': 10}
+
+# (seconds, sample rate, events per minute)
+CORPUS = [(length, sr, density)
+          for length in (10, 60)
+          for sr in (22050, 48000)
+          for density in (0, 20, 120)]
+QUICK_CORPUS = [(10, 22050, 20), (10, 48000, 120)]
+
+
+class LocalS3:
+    # Directory-backed stand-in for the parts of boto3's S3 resource the
+    # worker uses: Bucket(b).download_file/upload_file/upload_fileobj and
+    # Object(b, k).get()['Body']. <root>/<bucket>/<key> holds each object.
+    def __init__(self, root):
+        self.root = root
+
+    def Bucket(self, name):
+        return _LocalBucket(os.path.join(self.root, name))
+
+    def Object(self, bucket, key):
+        return _LocalObject(os.path.join(self.root, bucket, key))
+
+
+class _LocalBucket:
+    def __init__(self, path):
+        self.path = path
+
+    def _key(self, key):
+        p = os.path.join(self.path, key)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        return p
+
+    def download_file(self, key, path):
+        shutil.copyfile(os.path.join(self.path, key), path)
+
+    def upload_file(self, path, key):
+        shutil.copyfile(path, self._key(key))
+
+    def upload_fileobj(self, fp, key):
+        with open(self._key(key), 'wb') as out:
+            shutil.copyfileobj(fp, out)
+
+
+class _LocalObject:
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        return {'Body': open(self.path, 'rb')}
+
+
+def synth_recording(path, seconds, sr, density, seed):
+    # noise floor + `density` events per minute: tone bursts and linear
+    # chirps of random length, band and level
+    rng = np.random.RandomState(seed)
+    n = int(seconds * sr)
+    y = rng.normal(0, 0.01, n)
+    t = np.arange(n) / float(sr)
+    for _ in range(int(round(density * seconds / 60.0))):
+        dur = rng.uniform(0.1, 1.0)
+        start = rng.uniform(0, max(seconds - dur, 0))
+        f0 = rng.uniform(1000, min(10000, sr / 2 - 1000))
+        f1 = f0 if rng.rand() < 0.5 else rng.uniform(1000, min(10000, sr / 2 - 1000))
+        i0, i1 = int(start * sr), int(min(start + dur, seconds) * sr)
+        tt = t[i0:i1] - start
+        phase = 2 * np.pi * (f0 * tt + (f1 - f0) * tt ** 2 / (2 * dur))
+        y[i0:i1] += rng.uniform(0.05, 0.5) * np.sin(phase) * np.hanning(i1 - i0)
+    sf.write(path, np.clip(y, -1, 1).astype(np.float32), sr, format='FLAC', subtype='PCM_16')
+
+
+def build_corpus(s3_root, corpus):
+    # writes the corpus into the local RECBUCKET, returns
+    # [(uri, seconds, sr, density)]
+    recs = []
+    os.makedirs(os.path.join(s3_root, RECBUCKET, 'bench'), exist_ok=True)
+    for i, (seconds, sr, density) in enumerate(corpus):
+        uri = 'bench/rec_%d_%ds_%dhz_%depm.flac' % (i, seconds, sr, density)
+        synth_recording(os.path.join(s3_root, RECBUCKET, uri), seconds, sr, density, seed=i)
+        recs.append((uri, seconds, sr, density))
+    return recs
+
+
+SCHEMA = """
+CREATE TABLE recordings (recording_id INTEGER PRIMARY KEY, uri TEXT, datetime TIMESTAMP,
+                         duration REAL, sample_rate INTEGER, file_size INTEGER);
+CREATE TABLE playlist_recordings (playlist_id INTEGER, recording_id INTEGER);
+CREATE TABLE jobs (job_id INTEGER PRIMARY KEY, job_type_id INTEGER, state TEXT,
+                   progress INTEGER, progress_steps INTEGER, completed INTEGER,
+                   remarks TEXT, last_update TIMESTAMP);
+CREATE TABLE job_params_audio_event_detection_clustering (
+    job_id INTEGER, playlist_id INTEGER, project_id INTEGER, parameters TEXT);
+CREATE TABLE audio_event_detections_clustering (
+    aed_id INTEGER PRIMARY KEY AUTOINCREMENT, job_id INTEGER, recording_id INTEGER,
+    time_min REAL, time_max REAL, frequency_min REAL, frequency_max REAL,
+    aed_number INTEGER, uri_vector TEXT, uri_param TEXT);
+CREATE TABLE playlist_aed (playlist_id INTEGER, aed_id INTEGER);
+"""
+
+
+def build_db(path, s3_root, recs, job_id=1, plist_id=1, params=PARAMS):
+    # minimal arbimon schema with one waiting type-8 job over all of recs
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    for i, (uri, seconds, sr, density) in enumerate(recs):
+        size = os.path.getsize(os.path.join(s3_root, RECBUCKET, uri))
+        db.execute("INSERT INTO recordings VALUES (?, ?, ?, ?, ?, ?)",
+                   (i + 1, uri, '2020-01-01 %02d:00:00' % (i % 24), seconds, sr, size))
+        db.execute("INSERT INTO playlist_recordings VALUES (?, ?)", (plist_id, i + 1))
+    db.execute("INSERT INTO jobs VALUES (?, 8, 'waiting', 0, 0, 0, NULL, NULL)", (job_id,))
+    db.execute("INSERT INTO job_params_audio_event_detection_clustering VALUES (?, ?, 1, ?)",
+               (job_id, plist_id, json.dumps(params)))
+    db.commit()
+    db.close()
+
+
+def bench_stages(recs, work, repeat):
+    # best-of-`repeat` seconds per stage and recording
+    from aed_lib import (download_and_get_spec, find_events, compute_features,
+                         store_roi_images)
+    from aed_run_job import FILT_PCTL
+    args = (PARAMS['Filter Size'], FILT_PCTL, PARAMS['Amplitude Threshold'],
+            PARAMS['Bandwidth Threshold'], PARAMS['Duration Threshold'],
+            PARAMS['Area Threshold'])
+    rec_dir = os.path.join(work, 'recordings') + '/'
+    os.makedirs(rec_dir, exist_ok=True)
+    stages = {}
+    per_rec = []
+    for n, (uri, seconds, sr, density) in enumerate(recs):
+        best = {}
+        for r in range(repeat):
+            prefix = os.path.join(work, 'features_%d_%d' % (n, r))
+            t0 = time.perf_counter()
+            f, t, S = download_and_get_spec(uri, RECBUCKET, rec_dir)
+            t1 = time.perf_counter()
+            objs = find_events(S, f, t, *args)
+            t2 = time.perf_counter()
+            if objs:
+                compute_features(objs, n, (1.0, 0.0), S, f, t, prefix)
+            t3 = time.perf_counter()
+            store_roi_images(S, objs, n, work, 'bench/png/%d/' % n)
+            t4 = time.perf_counter()
+            for name, sec in (('download_and_get_spec', t1 - t0), ('find_events', t2 - t1),
+                              ('compute_features', t3 - t2), ('store_roi_images', t4 - t3)):
+                best[name] = min(best.get(name, sec), sec)
+        per_rec.append({'uri': uri, 'seconds': seconds, 'sample_rate': sr,
+                        'density': density, 'events': len(objs),
+                        'stages': {k: round(v, 4) for k, v in best.items()}})
+        for name, sec in best.items():
+            stages[name] = stages.get(name, 0.0) + sec
+    audio = float(sum(r[1] for r in recs))
+    return {name: {'seconds': round(sec, 4),
+                   'throughput': round(audio / sec, 2) if sec else None}
+            for name, sec in stages.items()}, per_rec
+
+
+def _iou(a, b):
+    # boxes as (tmin, tmax, fmin, fmax)
+    dt = min(a[1], b[1]) - max(a[0], b[0])
+    df = min(a[3], b[3]) - max(a[2], b[2])
+    if dt <= 0 or df <= 0:
+        return 0.0
+    inter = dt * df
+    return inter / ((a[1] - a[0]) * (a[3] - a[2]) + (b[1] - b[0]) * (b[3] - b[2]) - inter)
+
+
+def _matched(exact, coarse, iou=0.5):
+    # exact boxes with a coarse box at IoU >= iou (greedy, one-to-one)
+    free = list(coarse)
+    n = 0
+    for a in exact:
+        best = max(range(len(free)), key=lambda j: _iou(a, free[j]), default=None)
+        if best is not None and _iou(a, free[best]) >= iou:
+            free.pop(best)
+            n += 1
+    return n
+
+
+def bench_recall(recs, work, repeat):
+    # coarse-to-fine find_events vs the exact path on the same spectrograms.
+    # The 60 s recordings are long enough for the coarse path (COARSE_MIN_FRAMES);
+    # shorter ones take the exact path in both runs, so they count towards
+    # recall but not the speedup (None without a long enough recording).
+    from aed_lib import download_and_get_spec, find_events, COARSE_MIN_FRAMES
+    from aed_run_job import FILT_PCTL
+    args = (PARAMS['Filter Size'], FILT_PCTL, PARAMS['Amplitude Threshold'],
+            PARAMS['Bandwidth Threshold'], PARAMS['Duration Threshold'],
+            PARAMS['Area Threshold'])
+    rec_dir = os.path.join(work, 'recordings') + '/'
+    os.makedirs(rec_dir, exist_ok=True)
+    per_rec, totals = [], {'exact': 0, 'coarse': 0, 'matched': 0, 'exact_s': 0.0, 'coarse_s': 0.0}
+    for uri, seconds, sr, density in recs:
+        f, t, S = download_and_get_spec(uri, RECBUCKET, rec_dir)
+        boxes, secs = {}, {}
+        for mode in ('exact', 'coarse'):
+            for r in range(repeat):
+                t0 = time.perf_counter()
+                objs = find_events(S, f, t, *args, max_events=0, rank='energy', stats=None, mode=mode)
+                sec = time.perf_counter() - t0
+                secs[mode] = min(secs.get(mode, sec), sec)
+            boxes[mode] = [(t[o[1].start], t[o[1].stop - 1], f[o[0].start], f[o[0].stop - 1])
+                           for o in objs]
+        matched = _matched(boxes['exact'], boxes['coarse'])
+        long_enough = S.shape[1] >= COARSE_MIN_FRAMES
+        per_rec.append({'uri': uri, 'exact': len(boxes['exact']), 'coarse': len(boxes['coarse']),
+                        'matched': matched, 'exact_s': round(secs['exact'], 4),
+                        'coarse_s': round(secs['coarse'], 4), 'coarse_path': long_enough})
+        for k in ('exact', 'coarse'):
+            totals[k] += len(boxes[k])
+            if long_enough:
+                totals[k + '_s'] += secs[k]
+        totals['matched'] += matched
+    return {'recall': round(totals['matched'] / totals['exact'], 4) if totals['exact'] else 1.0,
+            'precision': round(totals['matched'] / totals['coarse'], 4) if totals['coarse'] else 1.0,
+            'speedup': round(totals['exact_s'] / totals['coarse_s'], 3) if totals['coarse_s'] else None,
+            'events': {k: totals[k] for k in ('exact', 'coarse', 'matched')},
+            'recordings': per_rec}
+
+
+def bench_e2e(recs, work, s3_root):
+    # aed_run_job.main() over the corpus against SQLite + LocalS3
+    import aed_run_job
+    db_path = os.path.join(work, 'arbimon.sqlite')
+    build_db(db_path, s3_root, recs)
+    os.environ.update({'ARBIMON_DB_DIALECT': 'sqlite', 'schema': db_path,
+                       'RECBUCKET': RECBUCKET, 'WRITEBUCKET': WRITEBUCKET,
+                       'AWS_SECRET': 'bench'})
+    aed_run_job.TEMP_DIR = os.path.join(work, 'job') + '/'
+    t0 = time.perf_counter()
+    rc = aed_run_job.main(1)
+    wall = time.perf_counter() - t0
+    with open(aed_run_job._work_dir(1) + '1_0_metrics.jsonl') as fp:
+        summary = json.loads(fp.read().splitlines()[-1])
+    db = sqlite3.connect(db_path)
+    state, = db.execute("SELECT state FROM jobs WHERE job_id = 1").fetchone()
+    events, = db.execute("SELECT COUNT(*) FROM audio_event_detections_clustering").fetchone()
+    db.close()
+    audio = float(sum(r[1] for r in recs))
+    return {'rc': rc, 'state': state, 'events': events, 'seconds': round(wall, 3),
+            'throughput': round(audio / wall, 2),
+            'recordings_per_s': round(len(recs) / wall, 3),
+            'stages': summary['stages']}
+
+
+# imported lazily by aed_lib; none may load just by importing a job entry point
+HEAVY_MODULES = ('scipy.signal', 'scipy.ndimage', 'skimage', 'PIL.Image', 'boto3', 'soundfile')
+
+_IMPORT_PROBE = '''
+import sys, json, time
+sys.path += %r
+t0 = time.perf_counter()
+import %s
+print(json.dumps({'seconds': time.perf_counter() - t0,
+                  'heavy': [m for m in %r if m in sys.modules]}))
+'''
+
+
+def import_check(budget):
+    # import each entry point in a fresh interpreter: time it and list any
+    # heavy module it pulled in. Returns (results, failure messages).
+    import subprocess
+    paths = [ROOT, os.path.join(ROOT, 'functions', 'worker')]
+    results, bad = {}, []
+    for module in ('aed_run_job', 'aed_batch'):
+        out = subprocess.check_output(
+            [sys.executable, '-c', _IMPORT_PROBE % (paths, module, HEAVY_MODULES)],
+            cwd=ROOT)
+        r = results[module] = json.loads(out.decode().splitlines()[-1])
+        r['seconds'] = round(r['seconds'], 3)
+        if r['heavy']:
+            bad.append('%s imports %s at load time' % (module, ', '.join(r['heavy'])))
+        if r['seconds'] > budget:
+            bad.append('%s import took %.2fs > %.2fs budget' % (module, r['seconds'], budget))
+    return results, bad
+
+
+def compare(result, baseline, tolerance):
+    # throughput regressions beyond tolerance, as messages
+    bad = []
+    pairs = [('stages.' + k, v['throughput'], baseline.get('stages', {}).get(k, {}).get('throughput'))
+             for k, v in result.get('stages', {}).items()]
+    if 'e2e' in result:
+        pairs.append(('e2e', result['e2e']['throughput'],
+                      baseline.get('e2e', {}).get('throughput')))
+    for name, now, base in pairs:
+        if now is None or not base:
+            continue
+        if now < base * (1 - tolerance):
+            bad.append('%s: %.2f < %.2f (-%.0f%%)' % (name, now, base, 100 * (1 - now / base)))
+    return bad
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--out', default='bench_results.json')
+    ap.add_argument('--baseline', help='earlier results JSON to compare against')
+    ap.add_argument('--tolerance', type=float, default=0.15,
+                    help='allowed throughput drop vs the baseline (fraction)')
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--quick', action='store_true', help='two short recordings only')
+    ap.add_argument('--skip-e2e', action='store_true')
+    ap.add_argument('--skip-recall', action='store_true')
+    ap.add_argument('--min-recall', type=float, default=0.9,
+                    help="min share of exact events the coarse detection mode must find")
+    ap.add_argument('--min-speedup', type=float, default=1.0,
+                    help="min find_events speedup of the coarse detection mode over exact")
+    ap.add_argument('--keep', action='store_true', help='keep the work directory')
+    ap.add_argument('--import-budget', type=float, default=1.0,
+                    help='max seconds to import aed_run_job / aed_batch')
+    ap.add_argument('--import-only', action='store_true',
+                    help='only run the import-time budget check')
+    a = ap.parse_args()
+
+    imports, import_bad = import_check(a.import_budget)
+    for msg in import_bad:
+        print('IMPORT BUDGET', msg)
+    if a.import_only:
+        print(json.dumps(imports, indent=2))
+        return 1 if import_bad else 0
+
+    work = tempfile.mkdtemp(prefix='aed_bench_')
+    s3_root = os.path.join(work, 's3')
+    import aed_lib
+    aed_lib.s3 = LocalS3(s3_root)
+    os.environ['WRITEBUCKET'] = WRITEBUCKET
+    try:
+        recs = build_corpus(s3_root, QUICK_CORPUS if a.quick else CORPUS)
+        result = {'python': platform.python_version(), 'machine': platform.machine(),
+                  'cpus': os.cpu_count(), 'numpy': np.__version__,
+                  'corpus': [dict(zip(('uri', 'seconds', 'sample_rate', 'density'), r))
+                             for r in recs],
+                  'audio_seconds': sum(r[1] for r in recs), 'imports': imports}
+        result['stages'], result['recordings'] = bench_stages(recs, work, a.repeat)
+        if not a.skip_recall:
+            result['recall'] = bench_recall(recs, work, a.repeat)
+        if not a.skip_e2e:
+            result['e2e'] = bench_e2e(recs, work, s3_root)
+    finally:
+        if not a.keep:
+            shutil.rmtree(work, ignore_errors=True)
+        else:
+            print('work directory:', work)
+
+    with open(a.out, 'w') as fp:
+        json.dump(result, fp, indent=2)
+    print(json.dumps({k: result[k] for k in ('stages', 'e2e') if k in result}, indent=2))
+    recall_bad = []
+    if 'recall' in result:
+        r = result['recall']
+        print('coarse detection: recall %.3f, precision %.3f, speedup %s'
+              % (r['recall'], r['precision'], r['speedup'] if r['speedup'] is not None
+                 else 'n/a (no recording reaches COARSE_MIN_FRAMES)'))
+        if r['recall'] < a.min_recall:
+            recall_bad.append('coarse recall %.3f < %.3f' % (r['recall'], a.min_recall))
+        if r['speedup'] is not None and r['speedup'] < a.min_speedup:
+            recall_bad.append('coarse speedup %.3f < %.3f' % (r['speedup'], a.min_speedup))
+    for msg in recall_bad:
+        print('RECALL', msg)
+    if a.baseline:
+        with open(a.baseline) as fp:
+            bad = compare(result, json.load(fp), a.tolerance)
+        for msg in bad:
+            print('REGRESSION', msg)
+        return 1 if bad or import_bad or recall_bad else 0
+    return 1 if import_bad or recall_bad else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
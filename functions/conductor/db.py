@@ -29,7 +29,10 @@ def connect():
 
     # Establish connection and return session
     dialect = os.environ.get('ARBIMON_DB_DIALECT', 'mysql').lower()
-    if dialect in ('postgres', 'postgresql', 'pg'):
+    if dialect == 'sqlite':
+        # offline benchmarks / local runs only: `schema` is the database file
+        engine = create_engine('sqlite:///' + schema)
+    elif dialect in ('postgres', 'postgresql', 'pg'):
         engine = create_engine(
             'postgresql+psycopg2://' + quote_plus(user) + ':'
             + quote_plus(password) + '@' + host + ':' + port + '/' + schema,
@@ -1,6 +1,8 @@
+import os
 import json
 import boto3
 from db import connect
+from aed_sched import cost_columns, row_costs, plan_chunks, LocalInvokeClient, DEFAULT_COST, PER_RECORDING_COST
 import sqlalchemy as sqal
 import datetime as dt
 import time
@@ -8,12 +10,15 @@ import time
 
 session, engine, metadata = connect() # RDS connection
 
-client = boto3.client('lambda')
+# AED_LAMBDA_CLIENT=local swaps in an offline stand-in that only records invokes
+if os.environ.get('AED_LAMBDA_CLIENT') == 'local':
+    client = LocalInvokeClient()
+else:
+    client = boto3.client('lambda')
 
-# Function to break playlist into chunks
-def divide_chunks(l, n): 
-    for i in range(0, len(l), n):  
-        yield l[i:i + n] 
+# Max estimated cost (audio samples, see aed_sched) per worker chunk. Default
+# is the old 125-recording cap applied to one-minute 44.1 kHz clips.
+CHUNK_COST = float(os.environ.get('AED_CHUNK_COST') or 125*(DEFAULT_COST+PER_RECORDING_COST))
 
 def driver(event, context):
     
@@ -35,6 +40,7 @@ def driver(event, context):
     print('DB connections...')
     plist_recs = sqal.Table('playlist_recordings', metadata, autoload=True, autoload_with=engine)
     plists = sqal.Table('playlists', metadata, autoload=True, autoload_with=engine)
+    recordings = sqal.Table('recordings', metadata, autoload=True, autoload_with=engine)
     job_params = sqal.Table('job_params_audio_event_detection_clustering', metadata, autoload=True, autoload_with=engine)
     jobs = sqal.Table('jobs', metadata, autoload=True, autoload_with=engine)
 
@@ -44,13 +50,21 @@ def driver(event, context):
     proj_id = session.execute(query).fetchall()[0][0]
     print('Project ID: '+str(proj_id))
     
-    # Get list of recording_id's
-    query = sqal.select([plist_recs.columns.recording_id]).where(plist_recs.columns.playlist_id==event['playlist_id'])
-    rec_ids = [i[0] for i in session.execute(query).fetchall()]
+    # Get list of recording_id's, with whatever the recordings table knows about their size
+    cost_cols = cost_columns(recordings)
+    query = sqal.select([plist_recs.columns.recording_id] + cost_cols) \
+                .select_from(plist_recs.join(recordings, recordings.c.recording_id==plist_recs.c.recording_id)) \
+                .where(plist_recs.columns.playlist_id==event['playlist_id']) \
+                .order_by(plist_recs.columns.recording_id)
+    result = session.execute(query).fetchall()
     
-    # Assign 10% of playlist to each item, with a max of N per item
-    recs_per_item = min(max(int(len(rec_ids)*0.1),1),125)
-    rec_ids = list(divide_chunks(rec_ids, recs_per_item))
+    # Pack recordings into chunks of even estimated cost: at least 10 chunks
+    # (the old 10%-per-item split), more when the playlist's total cost needs
+    # them to stay under CHUNK_COST each
+    costs = row_costs(result, [c.name for c in cost_cols], 1)
+    chunks = plan_chunks(costs, CHUNK_COST, min_chunks=10)
+    rec_ids = [[result[i][0] for i in chunk] for chunk in chunks]
+    print('Chunk costs: '+str([round(sum(costs[i] for i in chunk)) for chunk in chunks]))
     
     # # Insert new job
     ins = jobs.insert().values(job_type_id=8,
@@ -74,6 +88,11 @@ def driver(event, context):
                    ', "Bandwidth Threshold": '+str(event['Bandwidth Threshold']) + \
                    ', "Area Threshold": '+str(event['Filter Size']) + \
                    ', "Filter Size": '+str(event['Filter Size']) + \
+                   ', "Max Events": '+str(int(event.get('Max Events') or 0)) + \
+                   ', "Event Rank": '+json.dumps(event.get('Event Rank') or 'energy') + \
+                   ', "Min Frequency": '+str(float(event.get('Min Frequency') or 0)) + \
+                   ', "Max Frequency": '+str(float(event.get('Max Frequency') or 0)) + \
+                   ', "Detection Mode": '+json.dumps(event.get('Detection Mode') or 'exact') + \
                    '}'
                         
     ins = job_params.insert().values(name=event['name'],
@@ -120,6 +139,11 @@ def driver(event, context):
                                         "Bandwidth Threshold":float(event['Bandwidth Threshold']),
                                         "Area Threshold":float(event['Area Threshold']),
                                         "Filter Size":int(event['Filter Size']),
+                                        "Max Events":int(event.get('Max Events') or 0),
+                                        "Event Rank":event.get('Event Rank') or 'energy',
+                                        "Min Frequency":float(event.get('Min Frequency') or 0),
+                                        "Max Frequency":float(event.get('Max Frequency') or 0),
+                                        "Detection Mode":event.get('Detection Mode') or 'exact',
                     }))
         if context.get_remaining_time_in_millis()<20000:
             print('Running out of time, quitting to avoid auto-retry')
@@ -1,18 +1,30 @@
 from aed_lib import *
+from aed_metrics import Timer, JobMetrics
+import aed_profile
 from db import connect
 import sqlalchemy as sqal
 import datetime as dt
 import time # testing
 import shutil
 
-session, engine, metadata = connect() # RDS connection
+FILT_PCTL = 0.95
 
-recordings = sqal.Table('recordings', metadata, autoload=True, autoload_with=engine)
-aeds = sqal.Table('audio_event_detections_clustering', metadata, autoload=True, autoload_with=engine)
-playlist_aed = sqal.Table('playlist_aed', metadata, autoload=True, autoload_with=engine)
-jobs = sqal.Table('jobs', metadata, autoload=True, autoload_with=engine)
+_db = None
 
-FILT_PCTL = 0.95
+def _connect():
+
+    # RDS connection + table reflection, made on the first invocation (not at
+    # import, so cold starts don't pay for it up front) and kept for warm ones
+
+    global _db
+    if _db is None:
+        session, engine, metadata = connect() # RDS connection
+        _db = (session,
+               sqal.Table('recordings', metadata, autoload=True, autoload_with=engine),
+               sqal.Table('audio_event_detections_clustering', metadata, autoload=True, autoload_with=engine),
+               sqal.Table('playlist_aed', metadata, autoload=True, autoload_with=engine),
+               sqal.Table('jobs', metadata, autoload=True, autoload_with=engine))
+    return _db
 
 def handler(event, context):
 
@@ -28,12 +40,39 @@ def handler(event, context):
         # area threshold
         # playlist id
 
+    t0 = time.time()
+
+    session, recordings, aeds, playlist_aed, jobs = _connect()
+
     rec_ids = [int(i) for i in np.sort(np.array(event['recording_id']))]
     proj_id = event['project_id']
     job_id = event['job_id']
     plist_id = int(event['playlist_id'])
     print(str(len(rec_ids)), ' recs to process.')
 
+    #--- event cap / detection mode / band, checked like aed_run_job.run_job does
+    rank = str(event.get('Event Rank') or 'energy').lower()
+    mode = str(event.get('Detection Mode') or 'exact').lower()
+    fmin = float(event.get('Min Frequency') or 0)*1000
+    fmax = float(event.get('Max Frequency') or 0)*1000
+    bad = None
+    if rank not in EVENT_RANKS:
+        bad = 'Unknown Event Rank '+repr(event.get('Event Rank'))
+    elif mode not in DETECTION_MODES:
+        bad = 'Unknown Detection Mode '+repr(event.get('Detection Mode'))
+    else:
+        try:
+            check_band(fmin, fmax)
+        except ValueError as e:
+            bad = str(e)
+    if bad:
+        print('error: '+bad)
+        upd = jobs.update(jobs.c.job_id==event['job_id']).values(state='error', remarks=bad,
+                                                                 last_update=dt.datetime.now())
+        session.execute(upd)
+        session.commit()
+        return {'status' : 400}
+
     # define variables
     temp_dir = '/tmp/temp/'
     rec_dir = temp_dir+'/recordings/'
@@ -65,83 +104,107 @@ def handler(event, context):
     rec_dts = [to_unitcirc(i) for i in rec_dts]
 
     #--- process recordings
+    metrics = JobMetrics(job_id) # JSON lines to the Lambda log
+    profiler = aed_profile.from_env() # AED_PROFILE_*; no-op unless set
     unprocessed = 0
     for n, rec in enumerate(rec_uris):
 
+        timer = Timer()
+        objs = []
+        error = None
+        prof = {}
+        stats = {'dropped': 0}
         try:
+
+            with profiler.recording(n, rec_ids[n], prof):
             
-            image_uri = 'audio_events/'+os.environ['AWS_SECRET'].lower()+'/detection/'+str(job_id)+'/png/'+str(rec_ids[n])+'/'
+                image_uri = 'audio_events/'+os.environ['AWS_SECRET'].lower()+'/detection/'+str(job_id)+'/png/'+str(rec_ids[n])+'/'
     
-            if not os.path.exists(image_dir+'/'+str(rec_ids[n])):
-                os.mkdir(image_dir+'/'+str(rec_ids[n]))
+                if not os.path.exists(image_dir+'/'+str(rec_ids[n])):
+                    os.mkdir(image_dir+'/'+str(rec_ids[n]))
     
-            t0 = time.time()
+                #--- download recording and compute spectrogram
+                f, t, S = download_and_get_spec(rec, os.environ['RECBUCKET'], rec_dir, timer=timer,
+                                                fmin=fmin, fmax=fmax);
     
-            #--- download recording and compute spectrogram
-            f, t, S = download_and_get_spec(rec, os.environ['RECBUCKET'], rec_dir);
-    
-            #--- detect events
-            objs = find_events(S, f, t,
-                                event['Filter Size'], 
-                                FILT_PCTL, 
-                                event['Amplitude Threshold'], 
-                                event['Bandwidth Threshold'], 
-                                event['Duration Threshold'],
-                                event['Area Threshold']
-            )
+                #--- detect events
+                objs = find_events(S, f, t,
+                                    event['Filter Size'], 
+                                    FILT_PCTL, 
+                                    event['Amplitude Threshold'], 
+                                    event['Bandwidth Threshold'], 
+                                    event['Duration Threshold'],
+                                    event['Area Threshold'],
+                                    timer,
+                                    int(event.get('Max Events') or 0),
+                                    rank,
+                                    stats,
+                                    mode
+                )
             
-            if len(objs)>0:
+                if len(objs)>0:
                 
-                #--- bulk insert audio events to db
-                result = session.execute(
+                    #--- bulk insert audio events to db
+                    with timer.stage('db_insert'):
+                        result = session.execute(
         
-                    aeds.insert(),
+                            aeds.insert(),
         
-                    [{'job_id': int(job_id),
-                      'recording_id': int(rec_ids[n]),
-                      'time_min': float(t[ob[1].start]),
-                      'time_max': float(t[ob[1].stop-1]),
-                      'frequency_min': float(f[ob[0].start]),
-                      'frequency_max': float(f[ob[0].stop-1]),
-                      'aed_number': int(c),
-                      # mysql2pg BLOCKER B1 fix (2026-07-16 adversarial review):
-                      # the real column is uri_vector (varchar NOT NULL, no
-                      # default) on BOTH engines; there is no uri_image column.
-                      # SQLAlchemy silently DROPPED the bogus uri_image key AND
-                      # omitted uri_vector -> on MariaDB (blank/non-strict
-                      # sql_mode) uri_vector was auto-filled '' (live rows
-                      # confirm), but on PostgreSQL it raises NotNullViolation.
-                      # Writing '' here is byte-identical to today's MySQL rows.
-                      'uri_vector': '',
-                      # 2026-07-18 blank-ROI fix: the arbimon-legacy clustering
-                      # grid builds the ROI PNG URL from the uri_param COLUMN
-                      # (findRois: CONCAT('audio_events/<env>/detection/',
-                      # job_id, '/png/', recording_id, '/', uri_param, '.png')).
-                      # Omitting it => NULL => .../null.png => blank spectrogram
-                      # grid (user-reported; jobs 167492..167911 backfilled).
-                      # store_roi_images uploads PNGs keyed by the enumerate
-                      # index == aed_number, so uri_param must equal aed_number
-                      # (verified: all pre-regression rows have
-                      # uri_param == aed_number, 0 mismatches).
-                      'uri_param': int(c)
-                     }
+                            [{'job_id': int(job_id),
+                              'recording_id': int(rec_ids[n]),
+                              'time_min': float(t[ob[1].start]),
+                              'time_max': float(t[ob[1].stop-1]),
+                              'frequency_min': float(f[ob[0].start]),
+                              'frequency_max': float(f[ob[0].stop-1]),
+                              'aed_number': int(c),
+                              # mysql2pg BLOCKER B1 fix (2026-07-16 adversarial review):
+                              # the real column is uri_vector (varchar NOT NULL, no
+                              # default) on BOTH engines; there is no uri_image column.
+                              # SQLAlchemy silently DROPPED the bogus uri_image key AND
+                              # omitted uri_vector -> on MariaDB (blank/non-strict
+                              # sql_mode) uri_vector was auto-filled '' (live rows
+                              # confirm), but on PostgreSQL it raises NotNullViolation.
+                              # Writing '' here is byte-identical to today's MySQL rows.
+                              'uri_vector': '',
+                              # 2026-07-18 blank-ROI fix: the arbimon-legacy clustering
+                              # grid builds the ROI PNG URL from the uri_param COLUMN
+                              # (findRois: CONCAT('audio_events/<env>/detection/',
+                              # job_id, '/png/', recording_id, '/', uri_param, '.png')).
+                              # Omitting it => NULL => .../null.png => blank spectrogram
+                              # grid (user-reported; jobs 167492..167911 backfilled).
+                              # store_roi_images uploads PNGs keyed by the enumerate
+                              # index == aed_number, so uri_param must equal aed_number
+                              # (verified: all pre-regression rows have
+                              # uri_param == aed_number, 0 mismatches).
+                              'uri_param': int(c)
+                             }
         
-                     for c, ob in enumerate(objs)]
+                             for c, ob in enumerate(objs)]
         
-                )
-                session.commit()
+                        )
+                        session.commit()
         
-                #--- compute audio event features
-                compute_features(objs, rec_ids[n], rec_dts[n], S, f, t, feature_file_prefix)
+                    #--- compute audio event features
+                    compute_features(objs, rec_ids[n], rec_dts[n], S, f, t, feature_file_prefix, timer)
         
-                #--- store roi images
-                store_roi_images(S, objs, rec_ids[n], image_dir, image_uri)
+                    #--- store roi images
+                    store_roi_images(S, objs, rec_ids[n], image_dir, image_uri, timer)
                     
         except Exception as e:
             print(e)
             print('recording number: ',str(n))
             print('recording: ',rec)
             unprocessed+=1
+            error = e
+
+        metrics.record(rec_ids[n], rec, timer.stages, len(objs), error,
+                       dropped=stats['dropped'])
+        if prof:
+            aed_profile.upload(prof, os.environ['WRITEBUCKET'],
+                               'audio_events/'+os.environ['AWS_SECRET'].lower()+'/detection/'+str(job_id)+'/profiles/')
+
+    metrics.close()
+    print('processed '+str(len(rec_ids))+' recs in '+str(round(time.time()-t0, 1))+'s')
 
     #--- query for aed_ids
     print('mapping ids...')
@@ -177,8 +240,14 @@ def handler(event, context):
                                                      
     if unprocessed/len(rec_ids) < 0.5:
         print('updating job status')
-        upd = jobs.update(jobs.c.job_id==event['job_id']).values(progress=jobs.c.progress+1,
-                                                                 last_update=dt.datetime.now())
+        values = dict(progress=jobs.c.progress+1, last_update=dt.datetime.now())
+        if metrics.dropped:
+            #--- tell users the event cap truncated their output, as aed_run_job's
+            #--- _cap_remark does; every worker appends its own count
+            remark = (str(metrics.dropped)+' events dropped by the cap of '+str(int(event.get('Max Events') or 0))+
+                      ' per recording (ranked by '+rank+') in batch '+str(event['worker_id']))
+            values['remarks'] = sqal.func.coalesce(jobs.c.remarks+'; ', '')+remark
+        upd = jobs.update(jobs.c.job_id==event['job_id']).values(**values)
         session.execute(upd)
         session.commit()
     else: # if >=50% of recordings in the batch could not be processed, change job state to an error
@@ -0,0 +1,117 @@
+"""
+Per-recording wall-time and memory budget.
+
+One corrupt or huge recording (a noise-saturated file labelling hundreds
+of thousands of components, a multi-hour file whose spectrogram does not
+fit) used to hold up the whole job. With a budget, the DSP for each
+recording runs in a forked child that is killed once it overruns:
+
+  AED_REC_TIMEOUT=SEC   wall-time limit per recording
+  AED_REC_MAXMEM=MB     address-space limit (RLIMIT_AS) of the child
+
+An overrun raises BudgetExceeded in the caller, which counts the
+recording as unprocessed like any other failure. The child is a plain
+os.fork() so it also works from the pipeline's (daemonic) compute
+processes, and the function it runs needs no pickling; only its return
+value travels back, pickled over a pipe. The caller imports the DSP
+modules before the first fork (aed_lib.preload), so children start warm.
+
+A child forked from a multi-threaded process (the daemon with
+--concurrency > 1) can hang on a lock another thread held at fork time;
+only the timeout reaps it, so the daemon refuses AED_REC_MAXMEM without
+AED_REC_TIMEOUT there.
+
+Off (from_env() returns None) when neither variable is set.
+"""
+import os
+import sys
+import errno
+import time
+import pickle
+import select
+import signal
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    def __init__(self, timeout=0.0, max_mem_mb=0):
+        self.timeout = float(timeout)
+        self.max_mem = int(float(max_mem_mb) * 1024 * 1024)
+
+    def run(self, fn, *args):
+        # fn(*args) in a supervised child; returns its result or raises
+        # BudgetExceeded (or the child's own exception)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            _child(w, self.max_mem, fn, args)
+        os.close(w)
+        try:
+            data = self._read(r, pid)
+        finally:
+            os.close(r)
+        _, status = os.waitpid(pid, 0)
+        if not data:
+            if os.WIFSIGNALED(status):
+                how = 'killed by signal %d' % os.WTERMSIG(status)
+            else:
+                how = 'exit code %d' % os.WEXITSTATUS(status)
+            raise BudgetExceeded('recording worker died (%s)' % how)
+        ok, value = pickle.loads(data)
+        if ok:
+            return value
+        if isinstance(value, MemoryError) or (isinstance(value, OSError)
+                                               and value.errno == errno.ENOMEM):
+            raise BudgetExceeded('memory > %d MB' % (self.max_mem // (1024 * 1024)))
+        raise value
+
+    def _read(self, r, pid):
+        chunks = []
+        deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+        while True:
+            left = None if deadline is None else deadline - time.monotonic()
+            if left is not None and left <= 0:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                raise BudgetExceeded('wall time > %gs' % self.timeout)
+            ready, _, _ = select.select([r], [], [], left)
+            if not ready:
+                continue
+            chunk = os.read(r, 1 << 20)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+
+def _child(w, max_mem, fn, args):
+    # never returns: report fn's outcome on w and leave without running the
+    # parent's atexit handlers / finally blocks
+    try:
+        if max_mem:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (max_mem, max_mem))
+        payload = pickle.dumps((True, fn(*args)), -1)
+    except BaseException as e:
+        try:
+            payload = pickle.dumps((False, e), -1)
+        except Exception:
+            payload = pickle.dumps((False, RuntimeError(repr(e))), -1)
+    try:
+        with os.fdopen(w, 'wb') as fp:
+            fp.write(payload)
+    finally:
+        os._exit(0)
+
+
+def from_env():
+    timeout = float(os.environ.get('AED_REC_TIMEOUT') or 0)
+    max_mem = float(os.environ.get('AED_REC_MAXMEM') or 0)
+    if timeout <= 0 and max_mem <= 0:
+        return None
+    return Budget(timeout, max_mem)
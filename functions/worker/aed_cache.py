@@ -0,0 +1,93 @@
+"""
+Cross-job cache of per-recording AED results.
+
+The same recordings show up in many playlists/jobs with the same AED
+parameters; each job used to download and re-run the DSP for all of
+them. A cache entry holds everything aed_lib.analyze_recording returns
+for one recording (event boxes, feature rows, ROI PNGs), so a hit lets a
+job write its own detection rows, feature block and PNGs without
+touching the recording.
+
+Entries are content-addressed: the key hashes the recording URI, the
+STFT settings, the detection thresholds and aed_lib.AED_VERSION, so a
+parameter or code change simply misses. Zero-event results are cached
+too (most recordings of a noisy playlist have none).
+
+Stored as one .npz per recording under AED_CACHE_PREFIX in WRITEBUCKET;
+the cache is off when AED_CACHE_PREFIX is unset. Every cache failure is
+treated as a miss.
+"""
+import io
+import os
+import json
+import hashlib
+
+import numpy as np
+
+import aed_lib
+
+
+class ResultCache:
+    def __init__(self, bucket, prefix, args):
+        # args: the threshold / event cap arguments passed to analyze_recording
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/') + '/'
+        self.params = {
+            'stft': [aed_lib.WINLEN, aed_lib.NFFT, aed_lib.NOVERLAP],
+            'args': [a if isinstance(a, str) else float(a) for a in args],
+            'version': aed_lib.AED_VERSION,
+        }
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, uri):
+        blob = json.dumps(dict(self.params, uri=uri), sort_keys=True)
+        digest = hashlib.sha256(blob.encode('utf-8')).hexdigest()
+        return self.prefix + digest[:2] + '/' + digest + '.npz'
+
+    def get(self, uri, rec_id, rec_dt):
+        # Returns an analyze_recording result dict, or None on a miss. The
+        # recording-specific feature columns are rewritten from the current
+        # row in case the recording's datetime was edited since.
+        try:
+            body = aed_lib.s3.Object(self.bucket, self.key(uri)).get()['Body'].read()
+            z = np.load(io.BytesIO(body))
+            offsets = z['png_offsets']
+            raw = z['pngs'].tobytes()
+            res = {'boxes': [tuple(float(v) for v in b) for b in z['boxes']],
+                   'features': z['features'].copy(),
+                   'ids': z['ids'].copy(),
+                   'pngs': [raw[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)],
+                   'dropped': int(z['dropped']) if 'dropped' in z.files else 0}
+        except Exception:
+            self.misses += 1
+            return None
+        if len(res['boxes']):
+            res['features'][:, 0] = rec_dt[0]
+            res['features'][:, 1] = rec_dt[1]
+            res['features'][:, 6] = rec_id
+            res['ids'][:, 0] = rec_id
+        self.hits += 1
+        return res
+
+    def put(self, uri, res):
+        try:
+            offsets = np.cumsum([0] + [len(p) for p in res['pngs']]).astype(np.int64)
+            buf = io.BytesIO()
+            np.savez(buf,
+                     boxes=np.array(res['boxes'], dtype=np.float64).reshape((-1, 4)),
+                     features=res['features'], ids=res['ids'],
+                     pngs=np.frombuffer(b''.join(res['pngs']), dtype=np.uint8),
+                     png_offsets=offsets, dropped=np.int64(res.get('dropped', 0)))
+            buf.seek(0)
+            aed_lib.s3.Bucket(self.bucket).upload_fileobj(buf, self.key(uri))
+        except Exception as e:
+            print('cache store failed:', uri, e)
+
+
+def from_env(args):
+    # ResultCache configured from AED_CACHE_PREFIX / WRITEBUCKET, or None
+    prefix = os.environ.get('AED_CACHE_PREFIX')
+    if not prefix:
+        return None
+    return ResultCache(os.environ.get('WRITEBUCKET', 'arbimon2'), prefix, args)
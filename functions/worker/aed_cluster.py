@@ -0,0 +1,127 @@
+"""
+Streaming k-means over a job's event features.
+
+The job is "Audio Event Detection for Clustering", but clustering used to
+be a separate full pass that loads the whole feature matrix again. With
+the "Clusters" job parameter (k) set, the job keeps a mini-batch k-means
+model (Sculley, "Web-scale k-means clustering") over the HOG columns and
+updates it as recordings' feature blocks are written. At the end one
+streamed pass over <job>_0_features.npy assigns every event to its
+nearest centroid, and the job uploads next to the features:
+
+  <job>_0_clusters.npy   (N,) int32, cluster of each row of _features/_ids
+  <job>_0_centroids.npy  (k, 576) float64
+
+Memory is bounded by k centroids, one mini-batch and one block of rows.
+Sharded jobs fit once over the merged features in the reduce step, from
+the same streamed blocks (fit_file), instead of merging per-shard models.
+
+  "Clusters"       number of clusters; 0 or unset turns the stage off
+  "Cluster Batch"  rows per mini-batch update (default 256)
+"""
+import numpy as np
+
+META_COLUMNS = 7
+BLOCK_ROWS = 8192
+
+
+class MiniBatchKMeans:
+    def __init__(self, k, batch_size=256, seed=0):
+        self.k = int(k)
+        self.batch_size = int(batch_size)
+        self.rng = np.random.RandomState(seed)
+        self.centroids = None
+        self.counts = np.zeros(self.k)
+        self._buf = []
+        self._buffered = 0
+
+    def add(self, features):
+        # buffer a feature block (full 583-column rows); fit once a batch is full
+        if not len(features):
+            return
+        self._buf.append(np.asarray(features, dtype=np.float64)[:, META_COLUMNS:])
+        self._buffered += len(features)
+        # the first batch also seeds the centroids, so it needs >= k rows
+        if self._buffered >= max(self.batch_size, self.k if self.centroids is None else 0):
+            self.flush()
+
+    def flush(self):
+        if not self._buffered:
+            return
+        X = np.vstack(self._buf)
+        self._buf, self._buffered = [], 0
+        if self.centroids is None:
+            self.centroids = X[self.rng.choice(len(X), min(self.k, len(X)), replace=False)].copy()
+            if len(self.centroids) < self.k:
+                # fewer events than clusters so far: pad with jittered copies
+                extra = self.centroids[self.rng.choice(len(self.centroids), self.k - len(self.centroids))]
+                self.centroids = np.vstack([self.centroids, extra + self.rng.normal(0, 1e-6, extra.shape)])
+        self.partial_fit(X)
+
+    def partial_fit(self, X):
+        # per-center learning rate 1/count, applied to the batch mean of the
+        # rows assigned to each center
+        a = self.predict(X, hog=True)
+        m = np.bincount(a, minlength=self.k)
+        sums = np.zeros_like(self.centroids)
+        np.add.at(sums, a, X)
+        hit = m > 0
+        self.counts[hit] += m[hit]
+        self.centroids[hit] += (sums[hit] - m[hit][:, None] * self.centroids[hit]) / self.counts[hit][:, None]
+
+    def predict(self, X, hog=False):
+        # nearest centroid of each row (full feature rows unless hog=True)
+        X = np.asarray(X, dtype=np.float64)
+        if not hog:
+            X = X[:, META_COLUMNS:]
+        c2 = (self.centroids * self.centroids).sum(axis=1)
+        d = c2[None, :] - 2.0 * X.dot(self.centroids.T)
+        return d.argmin(axis=1)
+
+    def write(self, prefix):
+        # <prefix>_clusters.npy / _centroids.npy from <prefix>_features.npy;
+        # returns the suffixes written (none without features)
+        self.flush()
+        if self.centroids is None:
+            return []
+        features = np.load(prefix + '_features.npy', mmap_mode='r')
+        clusters = np.empty(len(features), dtype=np.int32)
+        for i in range(0, len(features), BLOCK_ROWS):
+            clusters[i:i + BLOCK_ROWS] = self.predict(features[i:i + BLOCK_ROWS])
+        np.save(prefix + '_clusters.npy', clusters)
+        np.save(prefix + '_centroids.npy', self.centroids)
+        return ['_clusters.npy', '_centroids.npy']
+
+
+def fit_file(model, prefix):
+    # stream <prefix>_features.npy through the model, then write() it
+    features = np.load(prefix + '_features.npy', mmap_mode='r')
+    for i in range(0, len(features), model.batch_size):
+        model.add(features[i:i + model.batch_size])
+    return model.write(prefix)
+
+
+def _whole(p, name, default):
+    # job parameter as a whole number >= 0; ValueError otherwise
+    v = p.get(name)
+    if v is None or v == '':
+        return default
+    try:
+        n = float(v)
+    except (TypeError, ValueError):
+        n = -1.0
+    if n < 0 or not n.is_integer():
+        raise ValueError('%s must be a positive integer, got %r' % (name, v))
+    return int(n)
+
+
+def from_params(p):
+    # MiniBatchKMeans for the job parameters, or None when the stage is off;
+    # ValueError on a negative / non-integer Clusters or Cluster Batch
+    k = _whole(p, 'Clusters', 0)
+    batch = _whole(p, 'Cluster Batch', 256)
+    if batch <= 0:
+        raise ValueError('Cluster Batch must be a positive integer, got %r' % p.get('Cluster Batch'))
+    if k <= 0:
+        return None
+    return MiniBatchKMeans(k, batch)
@@ -0,0 +1,144 @@
+"""
+Compact feature output for the clustering step.
+
+<job>_0_features.npy holds 583 float64 columns per event (7 metadata
+columns, see aed_lib.feature_block, plus 576 HOG values); for large jobs
+that is a multi-GB file the clustering step downloads and holds in
+memory. After detection, and without changing that file, this stage
+streams it in row blocks and writes alongside it:
+
+  <prefix>_meta.npy              the 7 metadata columns, float64
+  <prefix>_hog.npy               the HOG columns as "Feature Dtype"
+  <prefix>_features_reduced.npy  metadata + "Feature Dims" reduced HOG
+                                 columns, float32 (with a reduction)
+  <prefix>_projection.npz        mean / components of the reduction
+
+Job parameters (the stage is off unless one of them asks for something):
+
+  "Feature Dtype"      float64 (default), float32 or float16
+  "Feature Reduction"  none (default), pca or random
+  "Feature Dims"       output dimensions of the reduction (default 32)
+
+pca fits the top components from a covariance accumulated over the
+streamed blocks (one pass to fit, one to project), so memory stays at one
+block plus a 576x576 matrix. random is a seeded Gaussian projection and
+needs no fitting pass.
+"""
+import os
+
+import numpy as np
+from npy_append_array import NpyAppendArray
+
+META_COLUMNS = 7
+DTYPES = ('float64', 'float32', 'float16')
+REDUCTIONS = ('none', 'pca', 'random')
+BLOCK_ROWS = 4096
+
+
+class StreamingPCA:
+    def __init__(self, dims):
+        self.dims = dims
+        self.n = 0
+        self.sum = None
+        self.outer = None
+
+    def partial_fit(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if self.sum is None:
+            self.sum = np.zeros(X.shape[1])
+            self.outer = np.zeros((X.shape[1], X.shape[1]))
+        self.n += len(X)
+        self.sum += X.sum(axis=0)
+        self.outer += X.T.dot(X)
+
+    def finish(self):
+        self.mean = self.sum / max(self.n, 1)
+        cov = self.outer / max(self.n, 1) - np.outer(self.mean, self.mean)
+        w, v = np.linalg.eigh(cov)
+        components = v[:, ::-1][:, :self.dims].T
+        # eigenvector signs are arbitrary: make the largest entry positive so
+        # reruns over the same features give the same projection
+        signs = np.sign(components[np.arange(len(components)), np.abs(components).argmax(axis=1)])
+        self.components = components * np.where(signs == 0, 1, signs)[:, None]
+        return self
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=np.float64) - self.mean).dot(self.components.T)
+
+
+class RandomProjection:
+    def __init__(self, dims, n_features, seed=0):
+        rng = np.random.RandomState(seed)
+        self.mean = np.zeros(n_features)
+        self.components = rng.normal(0.0, 1.0 / np.sqrt(dims), (dims, n_features))
+
+    def partial_fit(self, X):
+        pass
+
+    def finish(self):
+        return self
+
+    def transform(self, X):
+        return np.asarray(X, dtype=np.float64).dot(self.components.T)
+
+
+class Compaction:
+    def __init__(self, dtype='float64', reduction='none', dims=32):
+        if dtype not in DTYPES:
+            raise ValueError('unknown Feature Dtype %r, expected one of %s' % (dtype, ', '.join(DTYPES)))
+        if reduction not in REDUCTIONS:
+            raise ValueError('unknown Feature Reduction %r, expected one of %s'
+                             % (reduction, ', '.join(REDUCTIONS)))
+        if int(dims) < 1:
+            raise ValueError('Feature Dims must be positive, got %r' % dims)
+        self.dtype = dtype
+        self.reduction = reduction
+        self.dims = int(dims)
+
+    def reducer(self, n_features):
+        dims = min(self.dims, n_features)
+        if self.reduction == 'pca':
+            return StreamingPCA(dims)
+        if self.reduction == 'random':
+            return RandomProjection(dims, n_features)
+        return None
+
+    def write(self, prefix, block_rows=BLOCK_ROWS):
+        # <prefix>_features.npy -> the files above; returns their suffixes
+        features = np.load(prefix + '_features.npy', mmap_mode='r')
+        suffixes = ['_meta.npy', '_hog.npy']
+        for suffix in suffixes + ['_features_reduced.npy']:
+            if os.path.exists(prefix + suffix):
+                os.remove(prefix + suffix)
+        blocks = [slice(i, i + block_rows) for i in range(0, len(features), block_rows)]
+        meta = NpyAppendArray(prefix + '_meta.npy')
+        hog = NpyAppendArray(prefix + '_hog.npy')
+        reducer = self.reducer(features.shape[1] - META_COLUMNS)
+        for b in blocks:
+            block = features[b]
+            meta.append(np.ascontiguousarray(block[:, :META_COLUMNS]))
+            hog.append(np.ascontiguousarray(block[:, META_COLUMNS:], dtype=self.dtype))
+            if reducer is not None:
+                reducer.partial_fit(block[:, META_COLUMNS:])
+        if reducer is None:
+            return suffixes
+        reducer.finish()
+        reduced = NpyAppendArray(prefix + '_features_reduced.npy')
+        for b in blocks:
+            block = features[b]
+            reduced.append(np.ascontiguousarray(np.hstack([
+                block[:, :META_COLUMNS], reducer.transform(block[:, META_COLUMNS:])]), dtype=np.float32))
+        np.savez(prefix + '_projection.npz', method=self.reduction,
+                 mean=reducer.mean, components=reducer.components)
+        return suffixes + ['_features_reduced.npy', '_projection.npz']
+
+
+def from_params(p):
+    # Compaction for the job parameters, or None when the stage is off;
+    # ValueError on an unknown dtype / reduction
+    dtype = str(p.get('Feature Dtype') or 'float64').lower()
+    reduction = str(p.get('Feature Reduction') or 'none').lower()
+    c = Compaction(dtype, reduction, p.get('Feature Dims') or 32)
+    if dtype == 'float64' and reduction == 'none':
+        return None
+    return c
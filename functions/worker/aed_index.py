@@ -0,0 +1,158 @@
+"""
+Approximate nearest-neighbour index over a job's event features.
+
+"Find events like this one" and the clustering step compare feature rows
+pairwise, which is quadratic in the number of events. With the "Build
+Index" job parameter set, the job ends by building an inverted-file (IVF)
+index over its final features and uploads it next to them as
+<job>_0_index.npz:
+
+  centroids  (nlist, d) float32   coarse k-means centroids
+  offsets    (nlist+1,) int64     list l is rows offsets[l]:offsets[l+1]
+  vectors    (N, d) float32       feature vectors, grouped by list
+  aed_ids    (N,) int64           aed_id of each row of `vectors`
+  space      'hog' or 'reduced'   which columns were indexed
+
+Indexed are the HOG columns of <job>_0_features.npy, or the reduced
+columns of <job>_0_features_reduced.npy when the job wrote one (see
+aed_compact); the metadata columns (time of day, band, position,
+recording) are left out of the similarity.
+
+A query scans the `nprobe` lists whose centroids are closest, so its cost
+is ~nprobe * N / nlist distance computations instead of N:
+
+    index = aed_index.load('123_0_index.npz')
+    aed_ids, dist = index.similar(aed_id, k=10)
+    aed_ids, dist = index.search(vectors, k=10, nprobe=8)
+
+Only numpy is needed to build or query (.npz is readable anywhere numpy
+is).
+"""
+import os
+
+import numpy as np
+
+META_COLUMNS = 7
+TRAIN_ITERS = 10
+TRAIN_PER_LIST = 64
+MAX_LISTS = 4096
+BLOCK_ROWS = 8192
+
+
+def _sqdist(X, C, c2):
+    # squared euclidean distances between the rows of X and C (c2: |C|^2)
+    d = (X * X).sum(axis=1)[:, None] - 2.0 * X.dot(C.T) + c2[None, :]
+    return np.maximum(d, 0.0)
+
+
+def _assign(X, C):
+    c2 = (C * C).sum(axis=1)
+    out = np.empty(len(X), dtype=np.int64)
+    for i in range(0, len(X), BLOCK_ROWS):
+        out[i:i + BLOCK_ROWS] = _sqdist(X[i:i + BLOCK_ROWS], C, c2).argmin(axis=1)
+    return out
+
+
+def train_centroids(X, nlist, iters=TRAIN_ITERS, seed=0):
+    # k-means (Lloyd) on a sample of X; empty clusters are reseeded
+    rng = np.random.RandomState(seed)
+    n = len(X)
+    sample = X[np.sort(rng.choice(n, min(n, nlist * TRAIN_PER_LIST), replace=False))]
+    sample = np.asarray(sample, dtype=np.float32)
+    C = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iters):
+        a = _assign(sample, C)
+        counts = np.bincount(a, minlength=nlist)
+        sums = np.zeros_like(C)
+        np.add.at(sums, a, sample)
+        empty = counts == 0
+        C[~empty] = sums[~empty] / counts[~empty][:, None]
+        if empty.any():
+            C[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+    return C
+
+
+class Index:
+    def __init__(self, centroids, offsets, vectors, aed_ids, space='hog'):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.vectors = vectors
+        self.aed_ids = aed_ids
+        self.space = space
+        self._row = None
+
+    def __len__(self):
+        return len(self.aed_ids)
+
+    def search(self, queries, k=10, nprobe=8):
+        # k nearest indexed events of each query vector: (aed_ids, squared
+        # distances), both (len(queries), k), padded with -1 / inf
+        Q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = max(1, min(int(nprobe), len(self.centroids)))
+        c2 = (self.centroids * self.centroids).sum(axis=1)
+        probes = np.argsort(_sqdist(Q, self.centroids, c2), axis=1)[:, :nprobe]
+        ids = np.full((len(Q), k), -1, dtype=np.int64)
+        dist = np.full((len(Q), k), np.inf, dtype=np.float32)
+        for i, q in enumerate(Q):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1])
+                                   for l in probes[i]])
+            if not len(rows):
+                continue
+            d = ((self.vectors[rows] - q) ** 2).sum(axis=1)
+            top = np.argpartition(d, min(k, len(d)) - 1)[:k] if len(d) > k else np.arange(len(d))
+            top = top[np.argsort(d[top], kind='stable')]
+            ids[i, :len(top)] = self.aed_ids[rows[top]]
+            dist[i, :len(top)] = d[top]
+        return ids, dist
+
+    def similar(self, aed_id, k=10, nprobe=8):
+        # events most like an indexed event, excluding the event itself
+        if self._row is None:
+            self._row = {int(a): r for r, a in enumerate(self.aed_ids)}
+        ids, dist = self.search(self.vectors[self._row[int(aed_id)]], k + 1, nprobe)
+        keep = ids[0] != int(aed_id)
+        return ids[0][keep][:k], dist[0][keep][:k]
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets,
+                 vectors=self.vectors, aed_ids=self.aed_ids, space=self.space)
+
+
+def build(vectors, aed_ids, nlist=None, space='hog', seed=0):
+    # IVF index over `vectors` (rows matching aed_ids); nlist defaults to
+    # ~sqrt(N) lists
+    vectors = np.asarray(vectors, dtype=np.float32)
+    aed_ids = np.asarray(aed_ids, dtype=np.int64).reshape(-1)
+    n = len(vectors)
+    if nlist is None:
+        nlist = int(np.sqrt(n))
+    nlist = max(1, min(int(nlist), MAX_LISTS, n))
+    centroids = train_centroids(vectors, nlist, seed=seed)
+    lists = _assign(vectors, centroids)
+    order = np.argsort(lists, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=nlist))]).astype(np.int64)
+    return Index(centroids, offsets, vectors[order], aed_ids[order], space)
+
+
+def build_for_job(prefix, nlist=None):
+    # <prefix>_index.npz from the job's final feature files (after aed_ids
+    # were mapped into <prefix>_ids.npy); returns its suffix, or None when
+    # there is nothing to index
+    if not os.path.exists(prefix + '_ids.npy'):
+        return None
+    aed_ids = np.load(prefix + '_ids.npy')
+    if not len(aed_ids):
+        return None
+    if os.path.exists(prefix + '_features_reduced.npy'):
+        vectors = np.load(prefix + '_features_reduced.npy', mmap_mode='r')[:, META_COLUMNS:]
+        space = 'reduced'
+    else:
+        vectors = np.load(prefix + '_features.npy', mmap_mode='r')[:, META_COLUMNS:]
+        space = 'hog'
+    build(vectors, aed_ids, nlist, space).save(prefix + '_index.npz')
+    return '_index.npz'
+
+
+def load(path):
+    z = np.load(path)
+    return Index(z['centroids'], z['offsets'], z['vectors'], z['aed_ids'], str(z['space']))
@@ -1,87 +1,440 @@
+import io
 import os
 import numpy as np
 from npy_append_array import NpyAppendArray
-import soundfile as sf # for reading audio files
-from scipy.signal import spectrogram, hann
-import scipy.ndimage
-import skimage.filters.rank
-import skimage.util
-import skimage.morphology
-from skimage.feature import hog
-import boto3
 import time
-from PIL import Image
 from math import sin, cos, pi
-# establish s3 connection
-s3 = boto3.resource('s3', endpoint_url=os.environ.get('S3_ENDPOINT') or None)
+from aed_storage import Storage, local_path
+# soundfile, scipy, skimage, PIL and boto3 are imported where they are used:
+# together they take seconds to import, which every Lambda cold start / k8s
+# Job start paid up front, even for jobs that fail before any recording.
 
 
-def find_events(S, f, t, filt_size, pctl, amp_thresh, bandwidth_thresh, duration_thresh, area_thresh):
+# establish s3 connection (lazily); file:// bucket names are local
+# directories instead (aed_storage)
+s3 = Storage()
+
+# Bump whenever a change here alters detections, features or ROI images, so
+# results cached by earlier code (aed_cache) are no longer reused.
+AED_VERSION = 1
+
+# spectrogram settings
+WINLEN, NFFT, NOVERLAP = 1024, 1024, 512
+
+
+class _NoTimer:
+    # default for the optional `timer` arguments below: anything with a
+    # stage(name) context manager (aed_metrics.Timer) records stage times
+    def stage(self, name):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_TIMER = _NoTimer()
+
+
+def preload():
+    # import the DSP modules now, e.g. before forking per-recording children
+    # (aed_budget) that would otherwise each import them again
+    import scipy.ndimage
+    import scipy.signal
+    import skimage.feature
+    import skimage.filters.rank
+    import skimage.morphology
+    import skimage.util
+    import soundfile
+    from PIL import Image
+    # skimage loads its submodules and PIL its format plugins on first use;
+    # resolve the ones used here too (a child under RLIMIT_AS cannot map
+    # their shared objects)
+    skimage.feature.hog, skimage.filters.rank.percentile
+    skimage.morphology.rectangle, skimage.util.img_as_ubyte
+    Image.init()
+
+
+DETECTION_MODES = ('exact', 'coarse')
+
+# coarse-to-fine detection (find_events mode='coarse')
+COARSE_POOL = (4, 4)        # frequency bins x frames max-pooled into one coarse cell
+COARSE_SLACK = 0.5          # coarse threshold uses slack*amp_thresh: over-select candidates, favour recall
+COARSE_STRIPS = 4           # time strips sampled to estimate the full-resolution threshold
+COARSE_SAMPLE = 1/16.0      # share of the frames those strips cover
+COARSE_MAX_COVER = 0.5      # candidate blocks covering more of the image than this: take the exact path
+COARSE_MIN_FRAMES = 2000    # shorter spectrograms always take the exact path
+
+
+def find_events(S, f, t, filt_size, pctl, amp_thresh, bandwidth_thresh, duration_thresh, area_thresh, timer=NO_TIMER,
+                max_events=0, rank='energy', stats=None, mode='exact'):
 
     # Detects audio events in a spectrogram. Returns a list of slices describing coordinates of events
+    # max_events > 0 keeps only the top max_events events by `rank` (see rank_events), in their
+    # original order; stats['dropped'] gets the number of events cut
+    # mode='coarse' runs the full-resolution filter only around candidates found on a pooled
+    # spectrogram (see coarse_mask), falling back to the exact path when they cover most of it
     
-    S = band_flatten(S)
+    import scipy.ndimage
+    import skimage.util
 
-    S += -S.min()
-    S *= (1.0/S.max())
-    
-    # Sfilt = skimage.filters.rank.percentile(skimage.util.img_as_ubyte(S), skimage.morphology.rectangle(filt_height, filt_width), p0=pctl)
-    Sfilt = skimage.filters.rank.percentile(skimage.util.img_as_ubyte(S), skimage.morphology.rectangle(int(filt_size/2), int(filt_size*5)), p0=pctl)
+    with timer.stage('band_flatten'):
+        S = band_flatten(S)
+
+        S += -S.min()
+        S *= (1.0/S.max())
 
-    # th = np.median(Sfilt.flatten())+amp_thresh*mad(Sfilt.flatten())
-    th = np.median(Sfilt.flatten())+amp_thresh*np.std(Sfilt.flatten())
-    mask = Sfilt > th
+    mask = None
+    if mode == 'coarse' and S.shape[1] >= COARSE_MIN_FRAMES:
+        mask = coarse_mask(skimage.util.img_as_ubyte(S), filt_size, pctl, amp_thresh, timer)
+    if mask is None:
+        with timer.stage('filter'):
+            # Sfilt = skimage.filters.rank.percentile(skimage.util.img_as_ubyte(S), skimage.morphology.rectangle(filt_height, filt_width), p0=pctl)
+            Sfilt = _rank_filter(skimage.util.img_as_ubyte(S), int(filt_size/2), int(filt_size*5), pctl)
 
-    labels, num_labels = scipy.ndimage.measurements.label(mask)
-    objs = scipy.ndimage.measurements.find_objects(labels)
+        with timer.stage('label'):
+            # th = np.median(Sfilt.flatten())+amp_thresh*mad(Sfilt.flatten())
+            th = np.median(Sfilt.flatten())+amp_thresh*np.std(Sfilt.flatten())
+            mask = Sfilt > th
+
+    with timer.stage('label'):
+        labels, num_labels = scipy.ndimage.measurements.label(mask)
+        objs = scipy.ndimage.measurements.find_objects(labels)
     
     keeps = [i for i in range(len(objs)) if (f[objs[i][0].stop-1]-f[objs[i][0].start])>=bandwidth_thresh*1000 and \
                                             (t[objs[i][1].stop-1]-t[objs[i][1].start])>=duration_thresh and \
                                             (f[objs[i][0].stop-1]-f[objs[i][0].start])/1000*(t[objs[i][1].stop-1]-t[objs[i][1].start])>=area_thresh]
+    if max_events and len(keeps) > max_events:
+        with timer.stage('rank'):
+            scores = rank_events(S, labels, [i+1 for i in keeps], rank)
+            top = sorted(range(len(keeps)), key=lambda j: (-scores[j], j))[:max_events]
+        if stats is not None:
+            stats['dropped'] = stats.get('dropped', 0) + len(keeps) - max_events
+        keeps = [keeps[j] for j in sorted(top)]
     objs = [objs[i] for i in keeps]
     
     return objs
 
 
+def _rank_filter(U, rows, cols, pctl):
+    import skimage.filters.rank
+    import skimage.morphology
+    return skimage.filters.rank.percentile(np.ascontiguousarray(U), skimage.morphology.rectangle(rows, cols), p0=pctl)
+
+
+def coarse_blocks(cand, shape, filt_size):
+
+    # Full-resolution boxes (row slice, column slice) to filter for the pooled candidate mask `cand`:
+    # the candidates are grown by the filter footprint plus a margin and each connected piece becomes
+    # one box, so candidates whose padded boxes would overlap are filtered together, once. Boxes are
+    # not padded; coarse_mask adds the footprint when filtering them. None when the grown candidates
+    # alone cover more than COARSE_MAX_COVER of the image.
+
+    import scipy.ndimage
+
+    fh, fw = int(filt_size/2), int(filt_size*5)
+    ph, pw = COARSE_POOL
+    H, W = shape
+    my, mx = fh//2 + ph, fw//2 + pw
+    ry, rx = -(-(my + fh)//ph), -(-(mx + fw)//pw)
+    grown = scipy.ndimage.binary_dilation(cand, structure=np.ones((ry + 1, rx + 1), dtype=bool))
+    if grown.mean() > COARSE_MAX_COVER:
+        return None
+    boxes = []
+    for r in scipy.ndimage.find_objects(scipy.ndimage.label(grown)[0]):
+        rows = np.flatnonzero(cand[r].any(axis=1)) + r[0].start
+        cols = np.flatnonzero(cand[r].any(axis=0)) + r[1].start
+        boxes.append([max(rows[0]*ph - my, 0), min((rows[-1] + 1)*ph + my, H),
+                      max(cols[0]*pw - mx, 0), min((cols[-1] + 1)*pw + mx, W)])
+    # bounding boxes of irregular pieces can still overlap: in time order, join a box into the one
+    # before it whenever filtering their union costs no more than filtering both
+    cost = lambda y0, y1, x0, x1: (min(y1 + fh, H) - max(y0 - fh, 0))*(min(x1 + fw, W) - max(x0 - fw, 0))
+    merged = []
+    for b in sorted(boxes, key=lambda b: b[2]):
+        if merged:
+            a = merged[-1]
+            u = [min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])]
+            if cost(*u) <= cost(*a) + cost(*b):
+                merged[-1] = u
+                continue
+        merged.append(b)
+    return [(slice(y0, y1), slice(x0, x1)) for y0, y1, x0, x1 in merged]
+
+
+def coarse_mask(U, filt_size, pctl, amp_thresh, timer=NO_TIMER):
+
+    # Coarse-to-fine version of find_events' filter + threshold on the uint8 spectrogram U:
+    #   1. max-pool U by COARSE_POOL (short / narrow events survive), filter and threshold the pooled
+    #      image with a lowered threshold and dilate by one cell: candidates, merged into a few
+    #      blocks (coarse_blocks)
+    #   2. if the blocks, padded by the filter footprint, cover more than COARSE_MAX_COVER of the
+    #      image, return None: filtering all of it once (the exact path) is cheaper
+    #   3. filter each block once at full resolution (padded so values at its edges are exact)
+    #   4. threshold them with the full-resolution statistics: the blocks' own values plus, for the
+    #      rest of the image, COARSE_STRIPS evenly spaced time strips covering COARSE_SAMPLE of the
+    #      frames
+    # The result matches the exact mask inside the blocks up to the sampled threshold; events the
+    # coarse pass misses entirely are lost (bench/aed_bench.py measures the recall and speedup).
+
+    import scipy.ndimage
+
+    fh, fw = int(filt_size/2), int(filt_size*5)
+    ph, pw = COARSE_POOL
+    H, W = U.shape
+    with timer.stage('coarse'):
+        Hp, Wp = -(-H//ph), -(-W//pw)
+        P = np.zeros((Hp*ph, Wp*pw), dtype=U.dtype)
+        P[:H, :W] = U
+        P = np.maximum.reduce([P[i::ph, j::pw] for i in range(ph) for j in range(pw)])
+        rows, cols = max(fh//ph, 1), max(fw//pw, 1)
+        if rows*cols*(1 - pctl) < 1:
+            # so few cells that their pctl percentile is their maximum: same values, far cheaper
+            Pfilt = scipy.ndimage.maximum_filter(P, (rows, cols))
+        else:
+            Pfilt = _rank_filter(P, rows, cols, pctl)
+        cand = Pfilt > np.median(Pfilt)+COARSE_SLACK*amp_thresh*np.std(Pfilt)
+        cand = scipy.ndimage.binary_dilation(cand, iterations=1)
+        blocks = coarse_blocks(cand, U.shape, filt_size)
+        if blocks is None:
+            return None
+        padded = [(min(r.stop + fh, H) - max(r.start - fh, 0))*(min(c.stop + fw, W) - max(c.start - fw, 0))
+                  for r, c in blocks]
+        if sum(padded) > COARSE_MAX_COVER*H*W:
+            return None
+
+    with timer.stage('filter'):
+        # each block once at full resolution, padded so values at its edges are exact; its values go
+        # into the threshold statistics as they are (Sfilt is uint8: a 256-bin histogram holds them)
+        covered = np.zeros(U.shape, dtype=bool)
+        hist = np.zeros(256)
+        filtered = []
+        for r, c in blocks:
+            py0, py1 = max(r.start - fh, 0), min(r.stop + fh, H)
+            px0, px1 = max(c.start - fw, 0), min(c.stop + fw, W)
+            Sfilt = _rank_filter(U[py0:py1, px0:px1], fh, fw, pctl)
+            Sfilt = Sfilt[r.start - py0:r.stop - py0, c.start - px0:c.stop - px0]
+            hist += np.bincount(Sfilt[~covered[r, c]], minlength=256)
+            covered[r, c] = True
+            filtered.append(Sfilt)
+
+        # the rest of the image from sampled strips, each padded like the blocks and weighted up to
+        # the area outside the blocks it stands for
+        sw = max(int(W*COARSE_SAMPLE/COARSE_STRIPS), fw, 1)
+        sample = np.zeros(256)
+        for x in np.linspace(0, W - sw, COARSE_STRIPS).astype(int):
+            x0, x1 = max(x - fw, 0), min(x + sw + fw, W)
+            Sfilt = _rank_filter(U[:, x0:x1], fh, fw, pctl)[:, x - x0:x - x0 + sw]
+            sample += np.bincount(Sfilt[~covered[:, x:x + sw]], minlength=256)
+        if sample.sum():
+            hist += sample*((U.size - covered.sum())/sample.sum())
+        median, std = _hist_stats(hist)
+        th = median+amp_thresh*std
+
+        mask = np.zeros(U.shape, dtype=bool)
+        for (r, c), Sfilt in zip(blocks, filtered):
+            mask[r, c] |= Sfilt > th
+    return mask
+
+
+def _hist_stats(hist):
+    # median (as np.median: mean of the two middle values) and std of values 0..len(hist)-1 counted
+    # (or weighted) by hist
+    v = np.arange(len(hist))
+    n = hist.sum()
+    cdf = np.cumsum(hist)
+    median = (np.searchsorted(cdf, np.floor((n - 1)/2.0) + 1) + np.searchsorted(cdf, np.floor(n/2.0) + 1))/2.0
+    mean = (hist*v).sum()/n
+    return median, np.sqrt((hist*(v - mean)**2).sum()/n)
+
+
+EVENT_RANKS = ('energy', 'area', 'peak')
+
+
+def rank_events(S, labels, index, rank='energy'):
+
+    # Score of each labelled component in `index` for capping a recording's events:
+    #   energy - mean (band-flattened, normalized) spectrogram level over the component
+    #   area   - component size in spectrogram bins
+    #   peak   - maximum level within the component
+
+    import scipy.ndimage
+    if rank == 'energy':
+        scores = scipy.ndimage.mean(S, labels, index)
+    elif rank == 'peak':
+        scores = scipy.ndimage.maximum(S, labels, index)
+    elif rank == 'area':
+        scores = np.bincount(labels.ravel(), minlength=max(index)+1)[index]
+    else:
+        raise ValueError('unknown event rank %r, expected one of %s' % (rank, ', '.join(EVENT_RANKS)))
+    return [float(x) for x in np.atleast_1d(scores)]
+
+
 def im_norm(x, trim=0.4):
     # normalizes an image, trim determines contrast, image min/max will be (trim/2)/(1-trim/2)
     return (x-x.min())/(x.max()-x.min())*(1-trim)+(trim/2)
 
 
-def store_roi_images(S, objs, rec_id, image_dir, image_uri):
-    for c, ob in enumerate(objs):
-        im = np.uint8(im_norm(-S[ob[0], ob[1]])*255)
-        im = np.flipud(im)
-        im = Image.fromarray(im).convert('RGB')
-        im.save(image_dir+'/tmp.png')
-        s3.Bucket(os.environ['WRITEBUCKET']).upload_file(image_dir+'/tmp.png',
-                                                         image_uri+str(c)+'.png')
+def render_roi_images(S, objs, timer=NO_TIMER):
+    # Renders the ROI of each event to PNG bytes, in aed_number order
+    from PIL import Image
+    pngs = []
+    with timer.stage('png_render'):
+        for c, ob in enumerate(objs):
+            im = np.uint8(im_norm(-S[ob[0], ob[1]])*255)
+            im = np.flipud(im)
+            im = Image.fromarray(im).convert('RGB')
+            buf = io.BytesIO()
+            im.save(buf, format='PNG')
+            pngs.append(buf.getvalue())
+    return pngs
+
+
+def upload_roi_images(pngs, image_uri, timer=NO_TIMER):
+    with timer.stage('png_upload'):
+        for c, png in enumerate(pngs):
+            s3.Bucket(os.environ['WRITEBUCKET']).upload_fileobj(io.BytesIO(png),
+                                                                image_uri+str(c)+'.png')
+
+
+def store_roi_images(S, objs, rec_id, image_dir, image_uri, timer=NO_TIMER):
+    upload_roi_images(render_roi_images(S, objs, timer), image_uri, timer)
 
         
-def download_and_get_spec(uri, bucket, rec_dir, winlen=1024, nfft=1024, noverlap=512):
+def download_recording(uri, bucket, rec_dir, timer=NO_TIMER):
 
-    # Downloads a recording and computes spectrogram
+    # Downloads a recording, returns the local path. Recordings in a file:// bucket are not
+    # copied: the path of the source file is returned (see discard_recording)
+
+    src = local_path(bucket, uri)
+    if src is not None:
+        return src
+    path = rec_dir + uri.replace('/','_')
+    with timer.stage('download'):
+        s3.Bucket(bucket).download_file(uri, path)
+    return path
 
-    s3.Bucket(bucket).download_file(uri, rec_dir + uri.replace('/','_'))
+
+def discard_recording(path, rec_dir):
+    # Removes a recording fetched by download_recording, unless it is a file:// source
+    if path.startswith(rec_dir):
+        os.remove(path)
+
+
+def decimation(samplerate, fmax, winlen=WINLEN, nfft=NFFT, noverlap=NOVERLAP, min_nfft=64):
+
+    # Largest power-of-two decimation factor that keeps fmax below 90% of the decimated Nyquist
+    # (clear of the anti-aliasing filter's roll-off) and divides the STFT sizes, so that the
+    # decimated STFT has the same frequency bins and frame times as the full-band one
+
+    q = 1
+    while fmax and samplerate/(2.0*q*2)*0.9 >= fmax and nfft//(q*2) >= min_nfft and \
+            winlen % (q*2) == 0 and nfft % (q*2) == 0 and noverlap % (q*2) == 0:
+        q *= 2
+    return q
+
+
+def check_band(fmin, fmax, samplerate=0):
+
+    # Raises ValueError for a "Min / Max Frequency" band (Hz) that cannot hold any STFT bin:
+    # negative, inverted or empty, or starting at or above the Nyquist frequency of `samplerate`
+    # (0: unknown)
+
+    if fmin < 0 or fmax < 0:
+        raise ValueError('Min / Max Frequency must not be negative')
+    if fmax and fmin >= fmax:
+        raise ValueError('Min Frequency (%g kHz) must be below Max Frequency (%g kHz)' % (fmin/1000.0, fmax/1000.0))
+    if samplerate and fmin >= samplerate/2.0:
+        raise ValueError('Min Frequency (%g kHz) is not below the Nyquist frequency (%g kHz)'
+                         % (fmin/1000.0, samplerate/2000.0))
+
+
+def get_spec(path, winlen=WINLEN, nfft=NFFT, noverlap=NOVERLAP, timer=NO_TIMER, fmin=0, fmax=0):
+
+    # Band-limited mode: with fmin/fmax (Hz) only bins within [fmin, fmax] are returned, and with
+    # fmax well below Nyquist the audio is first decimated by a power of two q and the STFT run
+    # with winlen/nfft/noverlap divided by q: same bin spacing and hop, 1/q of the work. f stays
+    # in absolute Hz.
+
+    from scipy.signal import spectrogram, hann, resample_poly
 
     # Load recording
-    data, samplerate, read_err = read_audio_dev(rec_dir + uri.replace('/','_'))
+    with timer.stage('decode'):
+        data, samplerate, read_err = read_audio_dev(path)
     if read_err:
         print('Warning: Ran into an unreadable block. File partially read')
 
+    q = decimation(samplerate, fmax, winlen, nfft, noverlap)
+    if q > 1:
+        with timer.stage('decimate'):
+            data = resample_poly(data, 1, q)
+        samplerate, winlen, nfft, noverlap = samplerate/float(q), winlen//q, nfft//q, noverlap//q
+
     # Compute spectrogram
-    f, t, S = spectrogram(data, samplerate, window=hann(winlen), nfft=nfft, noverlap=noverlap)
-    S = 10*np.log10((S+1e-12))
+    with timer.stage('stft'):
+        f, t, S = spectrogram(data, samplerate, window=hann(winlen), nfft=nfft, noverlap=noverlap)
+        if fmin or fmax:
+            lo = np.searchsorted(f, fmin, 'left')
+            hi = np.searchsorted(f, fmax, 'right') if fmax else len(f)
+            f, S = f[lo:hi], S[lo:hi]
+            if not len(f):
+                raise ValueError('no frequency bins in %g-%g Hz (Nyquist %g Hz)'
+                                 % (fmin, fmax or np.inf, samplerate*q/2.0))
+        S = 10*np.log10((S+1e-12))
     
     return f, t, S
+
+
+def download_and_get_spec(uri, bucket, rec_dir, winlen=WINLEN, nfft=NFFT, noverlap=NOVERLAP, timer=NO_TIMER,
+                          fmin=0, fmax=0):
+
+    # Downloads a recording and computes spectrogram
+
+    return get_spec(download_recording(uri, bucket, rec_dir, timer), winlen, nfft, noverlap, timer, fmin, fmax)
+
+
+def analyze_recording(path, rec_id, rec_dt, filt_size, pctl, amp_thresh, bandwidth_thresh, duration_thresh, area_thresh,
+                      max_events=0, rank='energy', fmin=0, fmax=0, mode='exact', timer=NO_TIMER):
+
+    # Decodes a local recording and computes everything a job writes for it, so
+    # callers (possibly in another process) never need the spectrogram itself:
+    #   boxes    - (time_min, time_max, frequency_min, frequency_max) per event
+    #   features - feature block, see feature_block
+    #   ids      - (recording_id, aed_number) per event
+    #   pngs     - ROI image bytes per event
+    #   dropped  - events cut by the max_events cap
+
+    f, t, S = get_spec(path, timer=timer, fmin=fmin, fmax=fmax)
+    return analyze_spectrogram(f, t, S, rec_id, rec_dt, filt_size, pctl, amp_thresh, bandwidth_thresh, duration_thresh,
+                               area_thresh, max_events, rank, mode, timer)
+
+
+def analyze_spectrogram(f, t, S, rec_id, rec_dt, filt_size, pctl, amp_thresh, bandwidth_thresh, duration_thresh,
+                        area_thresh, max_events=0, rank='energy', mode='exact', timer=NO_TIMER):
+
+    # analyze_recording after get_spec; S is only read, so it can be a read-only shared view
+
+    stats = {'dropped': 0}
+    objs = find_events(S, f, t, filt_size, pctl, amp_thresh, bandwidth_thresh, duration_thresh, area_thresh, timer,
+                       max_events, rank, stats, mode)
+    boxes = [(float(t[ob[1].start]), float(t[ob[1].stop-1]), float(f[ob[0].start]), float(f[ob[0].stop-1]))
+             for ob in objs]
+    features, ids = feature_block(objs, rec_id, rec_dt, S, f, t, timer)
+    return {'boxes': boxes, 'features': features, 'ids': ids, 'pngs': render_roi_images(S, objs, timer),
+            'dropped': stats['dropped']}
     
     
-def compute_features(objs, rec_id, rec_dt, S, f, t, out_file_prefix):
-    
-    # Computes features from audio events for a single recording and appends to two local files
-    #   <out_file_prefix>_features.npy
-    #   <out_file_prefix>_ids.npy
+def feature_block(objs, rec_id, rec_dt, S, f, t, timer=NO_TIMER):
 
+    # Computes features from audio events for a single recording
+
+    with timer.stage('features'):
+        return _feature_block(objs, rec_id, rec_dt, S, f, t)
+
+
+def _feature_block(objs, rec_id, rec_dt, S, f, t):
+    from PIL import Image
+    from skimage.feature import hog
     block_features = np.zeros((len(objs), 583))
     block_ids = np.zeros((len(objs), 2))
     for c, ob in enumerate(objs):
@@ -100,11 +453,30 @@ def compute_features(objs, rec_id, rec_dt, S, f, t, out_file_prefix):
                                         features
                                 ])
         block_ids[c,:] = [rec_id, c] # recording_id and aed_number
-        
+    return block_features, block_ids
+
+
+def append_features(out_file_prefix, block_features, block_ids):
+
+    # Appends a feature block to two local files
+    #   <out_file_prefix>_features.npy
+    #   <out_file_prefix>_ids.npy
+
     npaa = NpyAppendArray(out_file_prefix+'_features.npy')
     npaa.append(block_features)                    
     npab = NpyAppendArray(out_file_prefix+'_ids.npy')
     npab.append(block_ids)       
+
+
+def compute_features(objs, rec_id, rec_dt, S, f, t, out_file_prefix, timer=NO_TIMER):
+    
+    # Computes features from audio events for a single recording and appends to two local files
+    #   <out_file_prefix>_features.npy
+    #   <out_file_prefix>_ids.npy
+
+    block_features, block_ids = feature_block(objs, rec_id, rec_dt, S, f, t, timer)
+    with timer.stage('feature_write'):
+        append_features(out_file_prefix, block_features, block_ids)
     
     
 def to_unitcirc(n):
@@ -123,6 +495,8 @@ def band_flatten(X, percentile=50, divide=False):
 
 def read_audio_dev(path, mono=True, offset=0.0, duration=None, dtype=np.float32):
 
+    import soundfile as sf # for reading audio files
+
     y = []
     e_status=0
     with sf.SoundFile(os.path.realpath(path)) as input_file:
@@ -0,0 +1,134 @@
+"""
+Per-recording stage timings and structured job metrics.
+
+A Timer collects wall time per named stage for one recording; aed_lib
+functions take it as their optional `timer` argument (download, decode,
+stft, band_flatten, filter, label, features, png_render) and the job
+loop adds its own stages (cache, db_insert, feature_write, png_upload).
+
+JobMetrics writes one JSON line per recording plus a summary line (stage
+percentiles, throughput) when the job completes, to a file or, without
+one, to stdout (Lambda -> CloudWatch). With a Prometheus textfile path it
+also keeps live throughput / error counters there for node_exporter's
+textfile collector.
+"""
+import os
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Timer:
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - t0
+
+
+class JobMetrics:
+    def __init__(self, job_id, path=None, prom_path=None, prom_every=15):
+        self.job_id = job_id
+        self.fp = open(path, 'a') if path else None
+        self.prom_path = prom_path
+        self.prom_every = prom_every
+        self.t0 = time.time()
+        self._prom_t = 0.0
+        self.recordings = 0
+        self.errors = 0
+        self.events = 0
+        self.cached = 0
+        self.dropped = 0    # events cut by the per-recording cap
+        self.stage_times = {}
+        self.failed = []    # [{recording_id, uri, error}] for a later retry
+
+    def record(self, rec_id, uri, stages, events=0, error=None, cached=False, dropped=0):
+        self.recordings += 1
+        self.errors += error is not None
+        self.events += events
+        self.cached += bool(cached)
+        self.dropped += dropped
+        for name, sec in stages.items():
+            self.stage_times.setdefault(name, []).append(sec)
+        if error is not None:
+            self.failed.append({'recording_id': rec_id, 'uri': uri,
+                                'error': str(error)[:200]})
+        self._write({'type': 'recording', 'job_id': self.job_id,
+                     'recording_id': rec_id, 'uri': uri, 'events': events,
+                     'dropped': dropped, 'cached': bool(cached),
+                     'error': None if error is None else str(error)[:200],
+                     'total_s': round(sum(stages.values()), 4),
+                     'stages': {k: round(v, 4) for k, v in stages.items()},
+                     'ts': round(time.time(), 3)})
+        if self.prom_path and time.time() - self._prom_t >= self.prom_every:
+            self.write_prom()
+
+    def summary(self):
+        wall = time.time() - self.t0
+        stages = {}
+        for name, secs in self.stage_times.items():
+            a = np.asarray(secs)
+            p50, p90, p99 = np.percentile(a, [50, 90, 99])
+            stages[name] = {'count': len(a), 'total_s': round(float(a.sum()), 3),
+                            'mean_s': round(float(a.mean()), 4), 'p50_s': round(float(p50), 4),
+                            'p90_s': round(float(p90), 4), 'p99_s': round(float(p99), 4),
+                            'max_s': round(float(a.max()), 4)}
+        return {'type': 'summary', 'job_id': self.job_id,
+                'recordings': self.recordings, 'errors': self.errors,
+                'events': self.events, 'dropped': self.dropped, 'cached': self.cached,
+                'wall_s': round(wall, 3),
+                'recordings_per_s': round(self.recordings / wall, 4) if wall else 0.0,
+                'events_per_s': round(self.events / wall, 4) if wall else 0.0,
+                'stages': stages}
+
+    def close(self):
+        s = self.summary()
+        self._write(s)
+        if self.prom_path:
+            self.write_prom()
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        return s
+
+    def _write(self, line):
+        line = json.dumps(line)
+        if self.fp is not None:
+            self.fp.write(line + '\n')
+            self.fp.flush()
+        else:
+            print(line)
+
+    def write_prom(self):
+        # atomic replace so the collector never reads a half-written file
+        self._prom_t = time.time()
+        wall = max(self._prom_t - self.t0, 1e-9)
+        job = 'job_id="%s"' % self.job_id
+        lines = [
+            '# HELP aed_recordings_total Recordings finished by the AED job.',
+            '# TYPE aed_recordings_total counter',
+            'aed_recordings_total{%s} %d' % (job, self.recordings),
+            '# HELP aed_recording_errors_total Recordings that could not be processed.',
+            '# TYPE aed_recording_errors_total counter',
+            'aed_recording_errors_total{%s} %d' % (job, self.errors),
+            '# HELP aed_events_total Audio events detected.',
+            '# TYPE aed_events_total counter',
+            'aed_events_total{%s} %d' % (job, self.events),
+            '# HELP aed_recordings_per_second Recordings finished per second since job start.',
+            '# TYPE aed_recordings_per_second gauge',
+            'aed_recordings_per_second{%s} %.4f' % (job, self.recordings / wall),
+            '# HELP aed_stage_seconds_total Time spent per pipeline stage.',
+            '# TYPE aed_stage_seconds_total counter',
+        ] + ['aed_stage_seconds_total{%s,stage="%s"} %.3f' % (job, name, sum(secs))
+             for name, secs in sorted(self.stage_times.items())]
+        tmp = self.prom_path + '.tmp'
+        with open(tmp, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prom_path)
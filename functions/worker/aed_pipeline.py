@@ -0,0 +1,155 @@
+"""
+asyncio staged pipeline for the AED worker loop.
+
+Each recording flows through a chain of stages joined by bounded queues;
+every stage runs its own number of workers, either as coroutines, in a
+thread pool (blocking I/O: boto3, the DB session) or in a process pool
+(CPU-bound decode/STFT/detection). A slow stage only stalls the stages
+feeding it once their queue is full, so download, compute and writes
+overlap instead of being serialized in one `for` loop.
+
+Items are dicts. A stage function takes an item and returns the updated
+item; if it raises, the item is tagged with 'error'/'error_stage' and
+passed on untouched. Later stages skip failed items unless they were
+declared with errors=True (the sink uses that to count unprocessed
+recordings). Once the optional `stop` event (threading.Event) is set,
+every stage tags the items it receives 'skipped' and passes them on
+without running, except for errors=True stages, so the queues drain
+right away instead of finishing the work already in flight.
+
+Each stage keeps its own counters (items, errors, busy seconds, input
+queue depth) so the bottleneck is visible: a stage that is ~100% busy
+with an empty input queue is the limit; a full input queue means the
+stage after it is.
+"""
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+_STOP = object()
+
+
+class Stage:
+    def __init__(self, name, fn, workers=1, kind='thread', errors=False):
+        # kind: 'async' (fn is a coroutine function), 'thread' or 'process'
+        if kind not in ('async', 'thread', 'process'):
+            raise ValueError('unknown stage kind: ' + str(kind))
+        self.name = name
+        self.fn = fn
+        self.workers = max(int(workers), 1)
+        self.kind = kind
+        self.errors = errors
+        self.items = 0
+        self.gets = 0
+        self.failed = 0
+        self.skipped = 0
+        self.busy = 0.0
+        self.depth_max = 0
+        self.depth_sum = 0
+        self.queue = None
+
+    def stats(self, wall=None):
+        s = {'items': self.items, 'errors': self.failed, 'skipped': self.skipped,
+             'busy_s': round(self.busy, 3),
+             'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+             'queue_depth_max': self.depth_max,
+             'queue_depth_mean': round(self.depth_sum / self.gets, 2) if self.gets else 0.0}
+        if wall:
+            # fraction of the stage's worker capacity spent inside fn
+            s['utilization'] = round(self.busy / (wall * self.workers), 3)
+        return s
+
+
+class Pipeline:
+    def __init__(self, stages, queue_size=4, report_every=60, log=print, stop=None):
+        self.stages = stages
+        self.stop = stop
+        self.queue_size = queue_size
+        self.report_every = report_every
+        self.log = log
+        self.wall = 0.0
+
+    def run(self, items):
+        return asyncio.run(self._run(items))
+
+    def stats(self):
+        return {s.name: s.stats(self.wall) for s in self.stages}
+
+    async def _run(self, items):
+        loop = asyncio.get_running_loop()
+        for s in self.stages:
+            s.queue = asyncio.Queue(maxsize=self.queue_size * s.workers)
+        executors = {}
+        for s in self.stages:
+            if s.kind == 'thread':
+                executors[s.name] = ThreadPoolExecutor(s.workers, thread_name_prefix='aed-' + s.name)
+            elif s.kind == 'process':
+                executors[s.name] = ProcessPoolExecutor(s.workers)
+        t0 = time.perf_counter()
+        reporter = asyncio.ensure_future(self._report(t0))
+        try:
+            runners = [self._stage(i, s, executors.get(s.name), loop)
+                       for i, s in enumerate(self.stages)]
+            await asyncio.gather(self._feed(items), *runners)
+        finally:
+            reporter.cancel()
+            for ex in executors.values():
+                ex.shutdown(wait=True)
+            self.wall = time.perf_counter() - t0
+        self.log('pipeline done in %.1fs: %s' % (self.wall, self._line()))
+        return self.stats()
+
+    async def _feed(self, items):
+        first = self.stages[0]
+        for item in items:
+            await first.queue.put(item)
+        for _ in range(first.workers):
+            await first.queue.put(_STOP)
+
+    async def _stage(self, i, stage, executor, loop):
+        nxt = self.stages[i + 1] if i + 1 < len(self.stages) else None
+        await asyncio.gather(*[self._work(stage, nxt, executor, loop)
+                               for _ in range(stage.workers)])
+        if nxt is not None:
+            for _ in range(nxt.workers):
+                await nxt.queue.put(_STOP)
+
+    async def _work(self, stage, nxt, executor, loop):
+        while True:
+            stage.gets += 1
+            stage.depth_sum += stage.queue.qsize()
+            stage.depth_max = max(stage.depth_max, stage.queue.qsize())
+            item = await stage.queue.get()
+            if item is _STOP:
+                return
+            if self.stop is not None and self.stop.is_set() and 'skipped' not in item:
+                item['skipped'] = True
+            if stage.errors or ('error' not in item and 'skipped' not in item):
+                t0 = time.perf_counter()
+                try:
+                    if stage.kind == 'async':
+                        item = await stage.fn(item)
+                    else:
+                        item = await loop.run_in_executor(executor, stage.fn, item)
+                except Exception as e:
+                    item['error'] = e
+                    item['error_stage'] = stage.name
+                    stage.failed += 1
+                stage.busy += time.perf_counter() - t0
+                stage.items += 1
+            elif 'skipped' in item:
+                stage.skipped += 1
+            if nxt is not None:
+                await nxt.queue.put(item)
+
+    def _line(self):
+        wall = max(self.wall, 1e-9)
+        return ' '.join('%s[q=%d busy=%.1fs %d%%]' % (
+            s.name, s.queue.qsize(), s.busy, 100 * s.busy / (wall * s.workers))
+            for s in self.stages)
+
+    async def _report(self, t0):
+        while True:
+            await asyncio.sleep(self.report_every)
+            self.wall = time.perf_counter() - t0
+            self.log('pipeline %.0fs: %s' % (self.wall, self._line()))
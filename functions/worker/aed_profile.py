@@ -0,0 +1,116 @@
+"""
+On-demand profiling of production AED jobs.
+
+Off unless configured from the environment:
+
+  AED_PROFILE_EVERY=N          cProfile every N-th recording of the job
+  AED_PROFILE_SLOWER_THAN=SEC  cProfile every recording, keep those that
+                               took longer than SEC seconds (in addition
+                               to the every-N-th sample, if both are set)
+  AED_PROFILE_MEMORY=1         also take a tracemalloc snapshot of the
+                               profiled recordings (top allocations + peak)
+
+A kept recording yields <rec_id>.prof (pstats/snakeviz-loadable),
+<rec_id>_profile.txt (top functions by cumulative time) and, with
+AED_PROFILE_MEMORY, <rec_id>_memory.txt; the job uploads them to the
+write bucket under detection/<job>/profiles/. Profiling returns the
+files as bytes instead of writing them so it also works inside the
+pipeline's compute processes, and inside the forked children of a
+per-recording budget (aed_budget), which send them back with their result.
+
+When off, Profiler.recording() hands back a shared no-op context: no
+profiler is created and nothing is imported beyond this module.
+"""
+import io
+import os
+import time
+
+
+class _Off:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_OFF = _Off()
+
+
+class _Session:
+    def __init__(self, profiler, rec_id, out, sampled):
+        self.profiler = profiler
+        self.rec_id = rec_id
+        self.out = out
+        self.sampled = sampled
+
+    def __enter__(self):
+        import cProfile
+        if self.profiler.memory:
+            import tracemalloc
+            tracemalloc.start()
+        self.pr = cProfile.Profile()
+        self.t0 = time.perf_counter()
+        self.pr.enable()
+        return self
+
+    def __exit__(self, *exc):
+        import marshal
+        import pstats
+        self.pr.disable()
+        elapsed = time.perf_counter() - self.t0
+        snapshot = peak = None
+        if self.profiler.memory:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        slow = self.profiler.slower_than > 0 and elapsed >= self.profiler.slower_than
+        if not (self.sampled or slow):
+            return False
+        name = str(self.rec_id)
+        self.pr.create_stats()
+        self.out[name + '.prof'] = marshal.dumps(self.pr.stats)
+        text = io.StringIO()
+        text.write('recording %s: %.3fs\n' % (name, elapsed))
+        pstats.Stats(self.pr, stream=text).sort_stats('cumulative').print_stats(40)
+        self.out[name + '_profile.txt'] = text.getvalue().encode('utf-8')
+        if snapshot is not None:
+            lines = ['recording %s: peak traced memory %.1f MB' % (name, peak / 1e6)]
+            lines += [str(s) for s in snapshot.statistics('lineno')[:30]]
+            self.out[name + '_memory.txt'] = ('\n'.join(lines) + '\n').encode('utf-8')
+        return False
+
+
+class Profiler:
+    def __init__(self, every=0, slower_than=0.0, memory=False):
+        self.every = int(every)
+        self.slower_than = float(slower_than)
+        self.enabled = self.every > 0 or self.slower_than > 0
+        self.memory = bool(memory) and self.enabled
+        if self.enabled:
+            # imported here, in the job's process: a session entered in an
+            # aed_budget child could not map _lsprof under its RLIMIT_AS
+            import cProfile, marshal, pstats, tracemalloc  # noqa: F401
+
+    def recording(self, n, rec_id, out):
+        # context manager around the n-th recording of a job; fills `out`
+        # ({filename: bytes}) when the recording is sampled and kept
+        if not self.enabled:
+            return _OFF
+        sampled = self.every > 0 and n % self.every == 0
+        if not sampled and not self.slower_than > 0:
+            return _OFF
+        return _Session(self, rec_id, out, sampled)
+
+
+def from_env():
+    return Profiler(os.environ.get('AED_PROFILE_EVERY') or 0,
+                    os.environ.get('AED_PROFILE_SLOWER_THAN') or 0,
+                    os.environ.get('AED_PROFILE_MEMORY', '') not in ('', '0'))
+
+
+def upload(out, bucket, key_prefix):
+    # out from Profiler.recording -> <key_prefix><filename> in `bucket`
+    import aed_lib
+    for name, data in out.items():
+        aed_lib.s3.Bucket(bucket).upload_fileobj(io.BytesIO(data), key_prefix + name)
@@ -0,0 +1,91 @@
+"""
+Cost-balanced chunking of playlist recordings.
+
+Kept in lockstep with functions/conductor/aed_sched.py: the conductor
+packs Lambda chunks with it and aed_run_job --shard packs k8s shards with
+it, so both fan-out paths balance work the same way.
+
+AED cost is dominated by the STFT/filter/labelling passes, which scale
+with the number of audio samples, so a recording's cost is estimated as
+its sample count (duration * sample_rate), falling back to the object
+size (~1 byte per sample for 16-bit FLAC) and then to a one-minute
+44.1 kHz clip when the recordings row has nothing better. A fixed
+per-recording overhead accounts for the download / DB round trips that
+short clips are dominated by.
+"""
+import json
+import heapq
+import math
+
+DEFAULT_COST = 60 * 44100.0         # unknown recording: one minute at 44.1 kHz
+PER_RECORDING_COST = 5 * 44100.0    # download + DB round trips
+BYTES_PER_SAMPLE = 1.0              # FLAC 16-bit, ~50% compression
+COST_COLUMNS = ('samples', 'duration', 'sample_rate', 'file_size')
+
+
+def cost_columns(recordings):
+    # the cost-relevant columns present on a reflected recordings table
+    return [recordings.c[name] for name in COST_COLUMNS if name in recordings.c]
+
+
+def recording_cost(samples=None, duration=None, sample_rate=None, file_size=None):
+    # estimated work for one recording, in audio samples
+    if samples:
+        cost = float(samples)
+    elif duration and sample_rate:
+        cost = float(duration) * float(sample_rate)
+    elif file_size:
+        cost = float(file_size) / BYTES_PER_SAMPLE
+    else:
+        cost = DEFAULT_COST
+    return cost + PER_RECORDING_COST
+
+
+def row_costs(rows, names, offset):
+    # costs for query rows whose cost columns (`names`) start at `offset`
+    return [recording_cost(**dict(zip(names, r[offset:offset + len(names)])))
+            for r in rows]
+
+
+def pack(costs, n_bins):
+    # Longest-processing-time-first packing of item indices into n_bins bins
+    # of roughly even total cost. Deterministic: ties go to the earlier item
+    # and the lower bin, so every caller that sees the same costs computes
+    # the same assignment. Each bin keeps its items in original order.
+    n_bins = max(int(n_bins), 1)
+    bins = [[] for _ in range(n_bins)]
+    heap = [(0.0, b) for b in range(n_bins)]
+    for i in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, b = heapq.heappop(heap)
+        bins[b].append(i)
+        heapq.heappush(heap, (load + costs[i], b))
+    return [sorted(b) for b in bins]
+
+
+def plan_chunks(costs, max_cost, min_chunks=1):
+    # Number of chunks needed so that no chunk exceeds max_cost on average
+    # (never fewer than min_chunks, never more than one per item), then
+    # packed evenly. Returns the non-empty chunks as lists of item indices.
+    if not costs:
+        return []
+    n = max(int(min_chunks), int(math.ceil(sum(costs) / float(max_cost))))
+    n = min(n, len(costs))
+    return [b for b in pack(costs, n) if b]
+
+
+class LocalInvokeClient:
+    # Stand-in for boto3.client('lambda') so chunking/dispatch can run
+    # offline: records every invoke and, when given a handler, runs it
+    # in-process with the decoded payload.
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload='{}', **kwargs):
+        event = json.loads(Payload)
+        self.invocations.append({'FunctionName': FunctionName,
+                                 'InvocationType': InvocationType,
+                                 'event': event})
+        result = self.handler(event, None) if self.handler is not None else None
+        return {'StatusCode': 202 if InvocationType == 'Event' else 200,
+                'Payload': result}
@@ -0,0 +1,159 @@
+"""
+Shared-memory hand-off of spectrograms between pipeline processes.
+
+With AED_PIPELINE=async and AED_SHM_SLOTS=N, the pipeline's compute stage
+is split in two process stages: decode (audio -> f, t, S) and detect
+(find_events, features, PNGs). Returning S from one process and passing
+it to the next would pickle it twice; instead both sides share a ring of
+N reusable multiprocessing.shared_memory buffers:
+
+  parent   slot = ring.acquire()      blocks while all N are in use
+  decode   desc = ring.put(slot, {'f': f, 't': t, 'S': S})
+  detect   arrays = ring.view(desc)   zero-copy, read-only numpy views
+  parent   ring.release(slot)         once every consumer is done
+
+Only the descriptor (slot, offsets, shapes, dtypes) travels through the
+pipeline's queues. Slots are sized for the spectrogram of the playlist's
+longest recording (its aed_sched sample estimate, at most MAX_SLOT_MB),
+or AED_SHM_SLOT_MB when set. An array that does not fit its slot travels
+inline in the descriptor (pickled, as before), so a recording longer
+than estimated still works; the job counts these in its pipeline stats.
+Slots are reference counted: acquire(consumers=k) frees the slot after
+k releases.
+
+The ring object itself pickles to just the segment names; processes
+attach lazily on first use and keep the mapping for their lifetime.
+Attach (ring._buf(slot)) before forking an aed_budget child: an mmap
+failing under the child's RLIMIT_AS makes SharedMemory unlink the
+segment for every process. A worker keeps every slot it has used mapped,
+and its children inherit them: AED_REC_MAXMEM has to leave room for N
+slots on top of the recording itself. The
+parent owns the segments and unlinks them in close(). In containers,
+/dev/shm must be large enough for N slots (Docker defaults to 64 MB; on
+k8s mount an emptyDir with medium: Memory there).
+"""
+import os
+import threading
+
+import numpy as np
+
+ALIGN = 64
+MIN_SLOT_MB = 1
+MAX_SLOT_MB = 1024
+
+# segments this process attached to by name, kept for the process lifetime
+# (rings arrive freshly unpickled with every pipeline task)
+_ATTACHED = {}
+
+
+class SpecRing:
+    def __init__(self, slots, slot_bytes):
+        from multiprocessing import shared_memory
+        self.slot_bytes = int(slot_bytes)
+        self._shm = [shared_memory.SharedMemory(create=True, size=self.slot_bytes)
+                     for _ in range(int(slots))]
+        self.names = [s.name for s in self._shm]
+        self._owner = True
+        self._free = list(range(len(self.names)))[::-1]
+        self._refs = {}
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        return {'names': self.names, 'slot_bytes': self.slot_bytes}
+
+    def __setstate__(self, state):
+        self.names = state['names']
+        self.slot_bytes = state['slot_bytes']
+        self._shm = [None] * len(self.names)
+        self._owner = False
+
+    def _buf(self, slot):
+        if self._shm[slot] is None:
+            name = self.names[slot]
+            if name not in _ATTACHED:
+                from multiprocessing import shared_memory
+                _ATTACHED[name] = shared_memory.SharedMemory(name=name)
+            self._shm[slot] = _ATTACHED[name]
+        return self._shm[slot].buf
+
+    # owner side
+
+    def acquire(self, consumers=1):
+        with self._cond:
+            while not self._free:
+                self._cond.wait()
+            slot = self._free.pop()
+            self._refs[slot] = int(consumers)
+            return slot
+
+    def release(self, slot):
+        with self._cond:
+            self._refs[slot] -= 1
+            if self._refs[slot] <= 0:
+                del self._refs[slot]
+                self._free.append(slot)
+                self._cond.notify()
+
+    def close(self):
+        if not self._owner:
+            return
+        for s in self._shm:
+            s.close()
+            try:
+                s.unlink()
+            except FileNotFoundError:
+                pass  # a failed attach elsewhere already unlinked it
+        self._shm = []
+
+    # any process
+
+    def put(self, slot, arrays):
+        # copy `arrays` ({name: ndarray}) into the slot; returns the
+        # descriptor for view()
+        buf = self._buf(slot)
+        layout, inline, off = {}, {}, 0
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            start = -(-off // ALIGN) * ALIGN
+            if start + a.nbytes > self.slot_bytes:
+                inline[name] = a
+                continue
+            np.ndarray(a.shape, a.dtype, buffer=buf, offset=start)[...] = a
+            layout[name] = (start, a.shape, a.dtype.str)
+            off = start + a.nbytes
+        return {'slot': slot, 'layout': layout, 'inline': inline}
+
+    def view(self, desc):
+        # {name: ndarray} for a descriptor from put(); slot-backed arrays are
+        # read-only views, valid until the slot is released
+        buf = self._buf(desc['slot'])
+        out = dict(desc['inline'])
+        for name, (start, shape, dtype) in desc['layout'].items():
+            v = np.ndarray(shape, np.dtype(dtype), buffer=buf, offset=start)
+            v.flags.writeable = False
+            out[name] = v
+        return out
+
+
+def spec_bytes(samples):
+    # upper bound of get_spec's f, t, S for a recording of `samples` samples
+    # (full band; decimation keeps the frames, a band keeps fewer bins)
+    from aed_lib import NFFT, WINLEN, NOVERLAP
+    bins = NFFT // 2 + 1
+    frames = int(samples) // (WINLEN - NOVERLAP) + 1
+    return bins * frames * 4 + (bins + frames) * 8 + 3 * ALIGN
+
+
+def from_env(max_samples=0):
+    # SpecRing from AED_SHM_SLOTS, with slots of AED_SHM_SLOT_MB or else
+    # sized for a recording of max_samples; None (off) without AED_SHM_SLOTS
+    slots = int(os.environ.get('AED_SHM_SLOTS') or 0)
+    if slots <= 0:
+        return None
+    mb = float(os.environ.get('AED_SHM_SLOT_MB') or 0)
+    if mb <= 0:
+        mb = min(max(spec_bytes(max_samples) / (1024.0 * 1024), MIN_SLOT_MB), MAX_SLOT_MB)
+    return SpecRing(slots, mb * 1024 * 1024)
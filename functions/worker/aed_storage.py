@@ -0,0 +1,109 @@
+"""
+Storage backends for recordings and job artifacts, chosen by bucket name.
+
+aed_lib.s3 is a Storage: Bucket(name) / Object(bucket, key) hand back the
+boto3 S3 resource's objects (honoring S3_ENDPOINT), except for names of
+the form file:///some/dir, which map keys to files under that directory
+(an NFS / hostPath volume mounted into the pod). So RECBUCKET and
+WRITEBUCKET each pick their backend independently:
+
+  RECBUCKET=file:///mnt/recordings    read recordings off the volume
+  WRITEBUCKET=file:///mnt/aed         PNGs, feature files, metrics, cache
+
+Only the subset of the boto3 API the worker uses is implemented for
+files (download_file, upload_file, upload_fileobj, Object().get()).
+Writes land under a temporary name and are renamed into place, so a
+reader never sees a partial object, like with S3.
+
+For file-backed recordings there is nothing to download: local_path()
+gives the source file and aed_lib.download_recording returns it as is,
+so the decoder reads the volume directly instead of the recording taking
+a disk -> s3 proxy -> HTTP -> /tmp round trip.
+"""
+import os
+import shutil
+import threading
+
+FILE_SCHEME = 'file://'
+
+
+def local_root(bucket):
+    # directory behind a file:// bucket name, or None for an S3 bucket
+    if bucket and bucket.startswith(FILE_SCHEME):
+        return bucket[len(FILE_SCHEME):]
+    return None
+
+
+def local_path(bucket, key):
+    # source file of `key` in a file:// bucket, or None for an S3 bucket
+    root = local_root(bucket)
+    if root is None:
+        return None
+    return os.path.join(root, key.lstrip('/'))
+
+
+class FileBucket:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key.lstrip('/'))
+
+    def _write(self, key):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path, '%s.tmp%d' % (path, os.getpid())
+
+    def download_file(self, key, path):
+        shutil.copyfile(self._path(key), path)
+
+    def upload_file(self, path, key):
+        dest, tmp = self._write(key)
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, dest)
+
+    def upload_fileobj(self, fp, key):
+        dest, tmp = self._write(key)
+        with open(tmp, 'wb') as out:
+            shutil.copyfileobj(fp, out)
+        os.replace(tmp, dest)
+
+
+class FileObject:
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        return {'Body': open(self.path, 'rb')}
+
+
+class Storage:
+    # boto3 S3 resource, established on first use of an S3 bucket. The
+    # pipeline's fetch threads all get here at once, and boto3's default
+    # session is not thread-safe, so only one of them builds it.
+    _resource = None
+    _lock = threading.Lock()
+
+    def _s3(self):
+        if self._resource is None:
+            with self._lock:
+                if self._resource is None:
+                    import boto3
+                    type(self)._resource = boto3.resource(
+                        's3', endpoint_url=os.environ.get('S3_ENDPOINT') or None)
+        return self._resource
+
+    def Bucket(self, name):
+        root = local_root(name)
+        if root is not None:
+            return FileBucket(root)
+        return self._s3().Bucket(name)
+
+    def Object(self, bucket, key):
+        path = local_path(bucket, key)
+        if path is not None:
+            return FileObject(path)
+        return self._s3().Object(bucket, key)
+
+    def __getattr__(self, name):
+        return getattr(self._s3(), name)
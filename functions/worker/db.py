@@ -31,7 +31,10 @@ def connect():
 
     # Establish connection and return session
     dialect = os.environ.get('ARBIMON_DB_DIALECT', 'mysql').lower()
-    if dialect in ('postgres', 'postgresql', 'pg'):
+    if dialect == 'sqlite':
+        # offline benchmarks / local runs only: `schema` is the database file
+        engine = create_engine('sqlite:///' + schema)
+    elif dialect in ('postgres', 'postgresql', 'pg'):
         # executemany_mode: every session.execute(table.insert(), [dicts])
         # bulk path (detections / playlist_aed) becomes multi-row VALUES on
         # PG (worker-port template rule 4) without touching call sites.